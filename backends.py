@@ -0,0 +1,173 @@
+import json
+import urllib.request
+
+# Inference backends by name, the Model table records which one each model uses
+BACKENDS = {}
+
+DEFAULT_BACKEND = "llama_cpp"
+
+def register_backend(backend):
+    BACKENDS[backend.name] = backend
+    return backend
+
+def get_backend(name=None):
+    try:
+        return BACKENDS[name or DEFAULT_BACKEND]
+    except KeyError:
+        raise ValueError("Unknown backend {!r}, expected one of {}".format(name, ", ".join(sorted(BACKENDS))))
+
+def create_chat_model(backend, model_path, chat_format, **model_options):
+    return get_backend(backend).create_chat_model(model_path, chat_format, **model_options)
+
+class LlamaCppBackend:
+    # A backend builds a Llama-like engine for ChatModel: n_ctx, tokenize and create_chat_completion,
+    # plus save_state/load_state and embed where it can
+    name = "llama_cpp"
+    # Whether CPU tuning of threads, batch and context size applies
+    tunable = True
+    # Whether the engine can save and load its KV state, so sessions resume without re-evaluating them
+    stateful = True
+    # Whether the engine verifies drafted tokens, see speculative.py
+    speculative = True
+
+    def create_engine(self, model_path, chat_format, **options):
+        # Imported here so the app starts without loading llama.cpp
+        from llama_cpp import Llama
+        return Llama(model_path=model_path, chat_format=chat_format, **options)
+
+    def create_cache(self, capacity_bytes):
+        from llama_cpp import LlamaRAMCache
+        return LlamaRAMCache(capacity_bytes=capacity_bytes)
+
+    def set_abort_callback(self, llm, should_abort):
+        # llama_decode gives up between compute steps once should_abort returns True, so a long prompt
+        # evaluation can be stopped. Engines without a llama.cpp context ignore it
+        if not hasattr(llm, "_ctx"):
+            return
+        import llama_cpp
+        callback = llama_cpp.ggml_abort_callback(lambda data: bool(should_abort()))
+        # llama.cpp only keeps a pointer, the Llama holds the callback alive
+        llm.abort_callback = callback
+        llama_cpp.llama_set_abort_callback(llm._ctx.ctx, callback, None)
+
+    def create_chat_model(self, model_path, chat_format, **model_options):
+        from chatModel import ChatModel
+        return ChatModel(model_path=model_path, chat_format=chat_format, backend=self.name, **model_options)
+
+class FakeBackend(LlamaCppBackend):
+    # Deterministic replies with fixed per-token costs, for tests and benchmarks without a model
+    name = "fake"
+    tunable = False
+    stateful = False
+    speculative = False
+
+    def create_engine(self, model_path, chat_format, **options):
+        from fakeLlama import FakeLlama
+        return FakeLlama(model_path, chat_format=chat_format, **options)
+
+    def create_cache(self, capacity_bytes):
+        return None
+
+    def set_abort_callback(self, llm, should_abort):
+        llm.should_abort = should_abort
+
+class LlamaServerClient:
+    def __init__(self, model_path, chat_format=None, n_ctx=None, timeout=600, embedding=False, **options):
+        # The model path is the base URL of a running llama.cpp server, e.g. http://127.0.0.1:8080
+        self.model_path = model_path
+        self.base_url = model_path.rstrip("/")
+        self.timeout = timeout
+        self.cache = None
+        self.draft_model = None
+        self._n_ctx = n_ctx or self.fetch_n_ctx()
+
+    def request(self, path, payload=None):
+        data = json.dumps(payload).encode("utf-8") if payload is not None else None
+        request = urllib.request.Request(self.base_url + path, data=data, headers={"Content-Type": "application/json"})
+        return urllib.request.urlopen(request, timeout=self.timeout)
+
+    def fetch_n_ctx(self):
+        try:
+            with self.request("/props") as response:
+                return json.load(response)["default_generation_settings"]["n_ctx"]
+        except (OSError, ValueError, KeyError):
+            return 2048
+
+    def set_cache(self, cache):
+        self.cache = cache
+
+    def n_ctx(self):
+        return self._n_ctx
+
+    def tokenize(self, text, add_bos=True, special=False):
+        with self.request("/tokenize", {"content": text.decode("utf-8", errors="ignore")}) as response:
+            tokens = json.load(response)["tokens"]
+        # The server never adds BOS, a placeholder keeps counts in line with Llama.tokenize
+        return ([1] if add_bos else []) + tokens
+
+    def embed(self, text):
+        with self.request("/embedding", {"content": text}) as response:
+            return json.load(response)["embedding"]
+
+    def create_chat_completion(self, messages, stream=False, **params):
+        payload = dict(params, messages=messages, stream=stream)
+        response = self.request("/v1/chat/completions", payload)
+        if not stream:
+            with response:
+                return json.load(response)
+        return self.stream_chunks(response)
+
+    @staticmethod
+    def stream_chunks(response):
+        # Server-sent events, one JSON chunk per "data:" line
+        with response:
+            for line in response:
+                line = line.decode("utf-8").strip()
+                if not line.startswith("data:"):
+                    continue
+                data = line[5:].strip()
+                if data == "[DONE]":
+                    return
+                yield json.loads(data)
+
+class HttpBackend(LlamaCppBackend):
+    # Talks to a separately started llama-server, the model path holds its URL
+    name = "http"
+    tunable = False
+    # The KV state lives in the server process
+    stateful = False
+    speculative = False
+
+    def create_engine(self, model_path, chat_format, **options):
+        return LlamaServerClient(model_path, chat_format=chat_format, **options)
+
+    def create_cache(self, capacity_bytes):
+        # The server keeps its own prompt cache
+        return None
+
+class SubprocessBackend:
+    # ChatModel on llama_cpp, running in a child process that is restarted if it crashes
+    name = "subprocess"
+    tunable = True
+
+    def create_chat_model(self, model_path, chat_format, **model_options):
+        from processWorker import ProcessChatModel
+        # The child builds its own caches from plain settings
+        options = {
+            "sampling_params": model_options.get("sampling_params"),
+            "semantic_threshold": model_options.get("semantic_threshold"),
+            "speculative": model_options.get("speculative"),
+            "llama_options": model_options.get("llama_options"),
+            "backend": model_options.get("engine_backend", LlamaCppBackend.name),
+            "model_hash": model_options.get("model_hash"),
+        }
+        if model_options.get("state_store") is not None:
+            options["state_dir"] = model_options["state_store"].directory
+        if model_options.get("response_cache") is not None:
+            options["db_name"] = model_options["response_cache"].db_manager.db_name
+        return ProcessChatModel(model_path, chat_format, options)
+
+register_backend(LlamaCppBackend())
+register_backend(FakeBackend())
+register_backend(HttpBackend())
+register_backend(SubprocessBackend())
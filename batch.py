@@ -0,0 +1,231 @@
+import argparse
+import json
+import os
+import queue
+import sys
+import threading
+import time
+
+from backends import create_chat_model
+from database import DatabaseManager
+from ggufReader import resolve_chat_format
+
+class BatchRunner:
+    def __init__(self, models, input_path, output_path, checkpoint_path=None, max_in_flight=None, checkpoint_every=10):
+        # One ChatModel per worker thread, each with its own llama context
+        self.models = models
+        self.input_path = input_path
+        self.output_path = output_path
+        self.checkpoint_path = checkpoint_path or output_path + ".checkpoint"
+        self.max_in_flight = max_in_flight or 2 * len(models)
+        self.checkpoint_every = checkpoint_every
+        self.jobs = queue.Queue(maxsize=self.max_in_flight)
+        # Bounds the prompts read but not yet written, so memory stays constant
+        self.slots = threading.Semaphore(self.max_in_flight)
+        self.results = {}
+        self.results_ready = threading.Condition()
+
+    def load_checkpoint(self):
+        try:
+            with open(self.checkpoint_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {"line": 0, "offset": 0}
+
+    def save_checkpoint(self, line, offset):
+        with open(self.checkpoint_path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump({"line": line, "offset": offset}, f)
+        os.replace(self.checkpoint_path + ".tmp", self.checkpoint_path)
+
+    def read_prompts(self, skip):
+        # Stream the input file so arbitrarily large inputs never sit in memory.
+        # A line that is not a JSON object is yielded as the ValueError describing it
+        with open(self.input_path, "r", encoding="utf-8") as f:
+            for line_number, line in enumerate(f):
+                if line_number < skip:
+                    continue
+                line = line.strip()
+                if not line:
+                    yield line_number, None
+                    continue
+                try:
+                    record = json.loads(line)
+                    if not isinstance(record, dict):
+                        raise ValueError("expected a JSON object")
+                except ValueError as e:
+                    yield line_number, e
+                    continue
+                yield line_number, record
+
+    def run_prompt(self, model, record):
+        # Every prompt is answered on its own, without earlier prompts as context
+        if "messages" in record:
+            history, question = record["messages"][:-1], record["messages"][-1]["content"]
+        else:
+            history, question = [], record.get("prompt", record.get("question", ""))
+        model.reset_conversation(history)
+        model.session_id = None
+        start = time.perf_counter()
+        first_token = None
+        chunks = 0
+        response = ""
+        for token in model.generate_response(question, stream=True):
+            if first_token is None:
+                first_token = time.perf_counter() - start
+            chunks += 1
+            response += token
+        total = time.perf_counter() - start
+        return {
+            "id": record.get("id"),
+            "response": response.strip(),
+            "time_to_first_token": first_token,
+            "total_time": total,
+            "chunks": chunks,
+            "chunks_per_second": chunks / total if total > 0 else None,
+        }
+
+    def worker(self, model):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            line_number, record = job
+            if record is None:
+                result = None
+            else:
+                try:
+                    result = self.run_prompt(model, record)
+                except Exception as e:
+                    print("Error:", e, file=sys.stderr)
+                    result = {"id": record.get("id"), "error": str(e)}
+            with self.results_ready:
+                self.results[line_number] = result
+                self.results_ready.notify_all()
+
+    def writer(self, start_line, output):
+        # Write results in input order so the checkpoint is a single line number
+        next_line = start_line
+        written = 0
+        while True:
+            with self.results_ready:
+                while next_line not in self.results:
+                    self.results_ready.wait()
+                result = self.results.pop(next_line)
+            if result == "done":
+                break
+            if result is not None:
+                output.write(json.dumps(result, ensure_ascii=False) + "\n")
+            next_line += 1
+            written += 1
+            self.slots.release()
+            if written % self.checkpoint_every == 0:
+                output.flush()
+                self.save_checkpoint(next_line, output.tell())
+        output.flush()
+        self.save_checkpoint(next_line, output.tell())
+
+    def run(self):
+        checkpoint = self.load_checkpoint()
+        start_line = checkpoint["line"]
+        if start_line:
+            print("Resuming from line", start_line, file=sys.stderr)
+        mode = "r+" if start_line and os.path.exists(self.output_path) else "w"
+        with open(self.output_path, mode, encoding="utf-8") as output:
+            # Drop anything written after the last checkpoint
+            output.seek(checkpoint["offset"] if mode == "r+" else 0)
+            output.truncate()
+
+            workers = [threading.Thread(target=self.worker, args=(model,), daemon=True) for model in self.models]
+            for thread in workers:
+                thread.start()
+            writer = threading.Thread(target=self.writer, args=(start_line, output))
+            writer.start()
+
+            next_line = start_line
+            for line_number, record in self.read_prompts(start_line):
+                self.slots.acquire()
+                if isinstance(record, ValueError):
+                    # Recorded in the output like a failed prompt, the rest of the file still runs
+                    with self.results_ready:
+                        self.results[line_number] = {"line": line_number + 1, "error": "Invalid JSON: {}".format(record)}
+                        self.results_ready.notify_all()
+                else:
+                    self.jobs.put((line_number, record))
+                next_line = line_number + 1
+            for _ in workers:
+                self.jobs.put(None)
+            for thread in workers:
+                thread.join()
+            with self.results_ready:
+                self.results[next_line] = "done"
+                self.results_ready.notify_all()
+            writer.join()
+
+def main():
+    parser = argparse.ArgumentParser(description="Run prompts from a JSONL file through ChatModel without the GUI.")
+    parser.add_argument("input", help="JSONL file with one {\"id\", \"prompt\"} or {\"id\", \"messages\"} object per line")
+    parser.add_argument("output", help="JSONL file the responses and timings are written to")
+    parser.add_argument("--model", help="GGUF model path, defaults to the active model in the app database")
+    parser.add_argument("--chat-format", help="defaults to the format detected from the GGUF header")
+    parser.add_argument("--backend", help="inference backend, defaults to the one recorded for the model or llama_cpp")
+    parser.add_argument("--workers", type=int, default=1, help="number of model instances answering in parallel")
+    parser.add_argument("--max-in-flight", type=int, help="prompts read ahead of the output, defaults to twice the workers")
+    parser.add_argument("--checkpoint", help="checkpoint file, defaults to OUTPUT.checkpoint")
+    parser.add_argument("--processes", action="store_true",
+                        help="run each worker's model in its own process, pinned to its own block of CPUs")
+    parser.add_argument("--threads-per-worker", type=int, help="llama.cpp threads for each model instance")
+    parser.add_argument("--speculative", help="speculative decoding: \"lookup\" for prompt lookup or a draft GGUF path, "
+                                              "defaults to the model's setting")
+    parser.add_argument("--temperature", type=float)
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args()
+
+    db_manager = DatabaseManager()
+    db_manager.create_database()
+    model_path = args.model or db_manager.get_active_model_path()
+    if not model_path:
+        parser.error("no --model given and no active model found")
+    backend = args.backend or db_manager.get_model_backend(model_path)
+    speculative = args.speculative or db_manager.get_model_speculative(model_path)
+    chat_format = args.chat_format or resolve_chat_format(model_path, db_manager)
+    model_hash = db_manager.get_model_hash(model_path)
+
+    sampling_params = {}
+    if args.temperature is not None:
+        sampling_params["temperature"] = args.temperature
+    if args.seed is not None:
+        sampling_params["seed"] = args.seed
+
+    # Saved CPU tuning for this model and host, explicit flags override it
+    from cpuTuner import host_id, tuning_options
+    llama_options = tuning_options(db_manager.get_model_tuning(model_path, host_id()))
+    if args.threads_per_worker:
+        llama_options.update(n_threads=args.threads_per_worker, n_threads_batch=args.threads_per_worker)
+    if args.processes:
+        from workerPool import WorkerPool
+        pool = WorkerPool(model_path, chat_format, n_workers=args.workers, n_threads=args.threads_per_worker,
+                          options={"sampling_params": sampling_params, "speculative": speculative,
+                                   "model_hash": model_hash, "backend": backend,
+                                   # Threads are split between the workers, the tuned batch and context sizes still apply
+                                   "llama_options": {key: value for key, value in llama_options.items()
+                                                     if key in ("n_batch", "n_ctx")}})
+        models = pool.workers
+    else:
+        models = [create_chat_model(backend, model_path, chat_format, sampling_params=sampling_params,
+                                    llama_options=llama_options, speculative=speculative, model_hash=model_hash)
+                  for _ in range(args.workers)]
+    runner = BatchRunner(models, args.input, args.output, args.checkpoint, args.max_in_flight)
+    try:
+        runner.run()
+        for model in models:
+            # Worker processes report the counters of their last request
+            stats = model.speculative_stats()
+            if stats is not None:
+                print("Speculative decoding:", json.dumps(stats), file=sys.stderr)
+    finally:
+        for model in models:
+            if hasattr(model, "close"):
+                model.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,340 @@
+import collections
+import queue
+import threading
+import time
+
+import numpy as np
+
+from backends import get_backend
+
+class BatchRequest:
+    def __init__(self, request_id, prompt_tokens, max_tokens, temperature, top_p, seed, stop):
+        self.request_id = request_id
+        self.prompt_tokens = prompt_tokens
+        self.max_tokens = max_tokens
+        self.temperature = temperature
+        self.top_p = top_p
+        self.rng = np.random.default_rng(seed)
+        self.stop = [stop] if isinstance(stop, str) else list(stop or [])
+        # Decoded text is handed to the caller through this queue, None marks the end
+        self.output = queue.Queue()
+        self.cancelled = False
+        # Per-sequence decoding state, set once the request owns a KV slot
+        self.seq_id = None
+        self.n_past = 0
+        self.pending_tokens = list(prompt_tokens)
+        self.generated = []
+        self.text = ""
+        self.byte_buffer = b""
+        self.submitted = time.perf_counter()
+        self.started = None
+        self.first_token = None
+        self.finished = None
+
+    def __iter__(self):
+        while True:
+            text = self.output.get()
+            if text is None:
+                return
+            yield text
+
+    def result(self):
+        return "".join(self)
+
+    def cancel(self):
+        self.cancelled = True
+
+class LlamaBatchContext:
+    def __init__(self, llm, n_slots, n_batch, n_ctx):
+        # Imported here so the engine can run on the fake backend without llama.cpp
+        import llama_cpp
+        from llama_cpp import _internals
+        self.llama_cpp = llama_cpp
+        # A Llama's own context holds a single sequence, so the engine builds a second one on the same weights
+        # with a sequence id per slot. llm is then only used for tokenizing
+        params = llama_cpp.llama_context_params.from_buffer_copy(llm.context_params)
+        params.n_ctx = n_ctx
+        params.n_batch = n_batch
+        if hasattr(params, "n_seq_max"):
+            params.n_seq_max = n_slots
+        context_class = getattr(_internals, "LlamaContext", None) or _internals._LlamaContext
+        self.context = context_class(model=llm._model, params=params, verbose=llm.verbose)
+        self.ctx = self.context.ctx
+        if hasattr(llama_cpp, "llama_n_seq_max") and llama_cpp.llama_n_seq_max(self.ctx) < n_slots:
+            raise ValueError("llama.cpp allows {} sequences per context, {} slots were requested".format(
+                llama_cpp.llama_n_seq_max(self.ctx), n_slots))
+        self.n_vocab = llm.n_vocab()
+        self.batch = llama_cpp.llama_batch_init(n_batch, 0, 1)
+
+    def __del__(self):
+        if getattr(self, "batch", None) is not None:
+            self.llama_cpp.llama_batch_free(self.batch)
+            self.batch = None
+
+    def n_ctx(self):
+        return self.context.n_ctx()
+
+    def clear(self):
+        # Newer bindings replaced the kv_cache calls with llama_memory_*
+        if hasattr(self.llama_cpp, "llama_memory_clear"):
+            self.llama_cpp.llama_memory_clear(self.llama_cpp.llama_get_memory(self.ctx), True)
+        else:
+            self.context.kv_cache_clear()
+
+    def remove_sequence(self, seq_id):
+        if hasattr(self.llama_cpp, "llama_memory_seq_rm"):
+            self.llama_cpp.llama_memory_seq_rm(self.llama_cpp.llama_get_memory(self.ctx), seq_id, -1, -1)
+        else:
+            self.context.kv_cache_seq_rm(seq_id, -1, -1)
+
+    def decode(self, entries):
+        # entries are (token, position, seq_id, wants_logits), returns llama_decode's status
+        batch = self.batch
+        batch.n_tokens = len(entries)
+        for j, (token, pos, seq_id, logits) in enumerate(entries):
+            batch.token[j] = token
+            batch.pos[j] = pos
+            batch.n_seq_id[j] = 1
+            batch.seq_id[j][0] = seq_id
+            batch.logits[j] = logits
+        return self.llama_cpp.llama_decode(self.ctx, batch)
+
+    def logits(self, index):
+        return np.ctypeslib.as_array(self.llama_cpp.llama_get_logits_ith(self.ctx, index), shape=(self.n_vocab,))
+
+class BatchEngine:
+    def __init__(self, llm, chat_format, n_slots=4, n_batch=512, prefill_chunk=128, n_ctx=None):
+        # n_ctx is shared by all slots and defaults to llm's context size. Engines that cannot batch
+        # on their own, like the fake one, provide their context through batch_context
+        self.llm = llm
+        n_ctx = n_ctx or llm.n_ctx()
+        if hasattr(llm, "batch_context"):
+            self.context = llm.batch_context(n_slots, n_batch, n_ctx)
+        elif hasattr(llm, "_model"):
+            self.context = LlamaBatchContext(llm, n_slots, n_batch, n_ctx)
+        else:
+            raise ValueError("{} does not support continuous batching".format(type(llm).__name__))
+        self.chat_format = chat_format
+        self.formatter = None
+        self.n_slots = n_slots
+        self.n_batch = n_batch
+        # Long prompts are fed in chunks so they do not stall the sequences that are decoding
+        self.prefill_chunk = prefill_chunk
+        self.slot_ctx = self.context.n_ctx() // n_slots
+        self.eos = llm.token_eos()
+        self.waiting = collections.deque()
+        self.active = {}
+        self.free_slots = list(range(n_slots))
+        self.request_ids = 0
+        self.condition = threading.Condition()
+        self.running = False
+        self.thread = None
+        self.completed = collections.deque(maxlen=1000)
+        self.decode_steps = 0
+        self.generated_tokens = 0
+        self.busy_time = 0.0
+        self.context.clear()
+
+    @classmethod
+    def from_model_path(cls, model_path, chat_format, n_slots=4, n_ctx_per_slot=2048, n_batch=512, backend=None,
+                        **kwargs):
+        # The Llama's own context is only used for tokenizing, so keep it small and size the batching
+        # context for all slots
+        llm = get_backend(backend).create_engine(model_path, chat_format, n_ctx=n_batch, n_batch=n_batch,
+                                                 verbose=False, **kwargs)
+        return cls(llm, chat_format, n_slots=n_slots, n_batch=n_batch, n_ctx=n_slots * n_ctx_per_slot)
+
+    def format_prompt(self, messages):
+        if hasattr(self.llm, "format_prompt"):
+            return self.llm.format_prompt(messages)
+        from llama_cpp import llama_chat_format
+        if self.chat_format is None:
+            return self.template_formatter()(messages=messages)
+        # Chat formats register their formatter as format_<name> in llama_chat_format
+        name = self.chat_format.replace("-", "_")
+        formatter = getattr(llama_chat_format, "format_" + name, None) or \
+            getattr(llama_chat_format, "format_" + name.replace("_", ""))
+        return formatter(messages=messages)
+
+    def template_formatter(self):
+        # Models without a named format are prompted with the template embedded in the GGUF file
+        if self.formatter is None:
+            from llama_cpp import llama_chat_format
+            metadata = self.llm.metadata
+            eos = int(metadata.get("tokenizer.ggml.eos_token_id", self.llm.token_eos()))
+            bos = int(metadata.get("tokenizer.ggml.bos_token_id", self.llm.token_bos()))
+            self.formatter = llama_chat_format.Jinja2ChatFormatter(
+                template=metadata["tokenizer.chat_template"],
+                eos_token=self.llm._model.token_get_text(eos),
+                bos_token=self.llm._model.token_get_text(bos),
+            )
+        return self.formatter
+
+    def submit(self, messages, max_tokens=256, temperature=0.2, top_p=0.95, seed=None, stop=None):
+        formatted = self.format_prompt(messages)
+        prompt_tokens = self.llm.tokenize(formatted.prompt.encode("utf-8"), special=True)
+        # Keep the end of the prompt when it would not leave room for the reply in the slot
+        max_tokens = min(max_tokens, self.slot_ctx // 2)
+        prompt_tokens = prompt_tokens[-(self.slot_ctx - max_tokens):]
+        stop = list(stop or []) + ([formatted.stop] if isinstance(formatted.stop, str) else list(formatted.stop or []))
+        with self.condition:
+            self.request_ids += 1
+            request = BatchRequest(self.request_ids, prompt_tokens, max_tokens, temperature, top_p, seed, stop)
+            self.waiting.append(request)
+            self.condition.notify_all()
+        return request
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        if self.thread is not None:
+            self.thread.join()
+
+    def loop(self):
+        while True:
+            with self.condition:
+                while self.running and not self.waiting and not self.active:
+                    self.condition.wait()
+                if not self.running:
+                    break
+                self.admit()
+            self.step()
+        for request in list(self.active.values()) + list(self.waiting):
+            request.output.put(None)
+
+    def admit(self):
+        # Waiting requests take free slots in arrival order
+        while self.waiting and self.free_slots:
+            request = self.waiting.popleft()
+            if request.cancelled:
+                request.output.put(None)
+                continue
+            request.seq_id = self.free_slots.pop(0)
+            request.started = time.perf_counter()
+            self.active[request.seq_id] = request
+
+    def step(self):
+        entries = []
+        sampled = []
+        # Sequences that are decoding add one token each, prompts fill the remaining room in chunks
+        requests = sorted(self.active.values(), key=lambda request: len(request.pending_tokens))
+        for request in requests:
+            if request.cancelled:
+                continue
+            room = self.n_batch - len(entries)
+            if room <= 0:
+                break
+            tokens = request.pending_tokens[:min(room, self.prefill_chunk)]
+            entries.extend((token, request.n_past + i, request.seq_id, False) for i, token in enumerate(tokens))
+            request.pending_tokens = request.pending_tokens[len(tokens):]
+            request.n_past += len(tokens)
+            if not request.pending_tokens:
+                # The last token of the sequence in this batch produces the next-token logits
+                entries[-1] = entries[-1][:3] + (True,)
+                sampled.append((request, len(entries) - 1))
+
+        start = time.perf_counter()
+        if entries:
+            result = self.context.decode(entries)
+            if result != 0:
+                print("Error: llama_decode returned", result)
+                for request in list(self.active.values()):
+                    self.finish(request)
+                return
+        self.decode_steps += 1
+
+        for request, index in sampled:
+            token = self.sample(request, self.context.logits(index))
+            self.accept(request, token)
+        for request in list(self.active.values()):
+            if request.cancelled:
+                self.finish(request)
+        self.busy_time += time.perf_counter() - start
+
+    @staticmethod
+    def sample(request, logits):
+        if request.temperature <= 0:
+            return int(np.argmax(logits))
+        logits = logits.astype(np.float64) / request.temperature
+        probs = np.exp(logits - logits.max())
+        probs /= probs.sum()
+        if request.top_p < 1.0:
+            # Nucleus sampling: keep the smallest set of tokens covering top_p of the mass
+            order = np.argsort(probs)[::-1]
+            cumulative = np.cumsum(probs[order])
+            keep = order[:int(np.searchsorted(cumulative, request.top_p)) + 1]
+            filtered = np.zeros_like(probs)
+            filtered[keep] = probs[keep]
+            probs = filtered / filtered.sum()
+        return int(request.rng.choice(len(probs), p=probs))
+
+    def accept(self, request, token):
+        if request.first_token is None:
+            request.first_token = time.perf_counter()
+        if token == self.eos:
+            self.finish(request)
+            return
+        request.generated.append(token)
+        self.generated_tokens += 1
+        # Hold back bytes until they form complete UTF-8 characters
+        request.byte_buffer += self.llm.detokenize([token], prev_tokens=request.prompt_tokens + request.generated[:-1])
+        try:
+            text = request.byte_buffer.decode("utf-8")
+            request.byte_buffer = b""
+        except UnicodeDecodeError:
+            text = ""
+        if text:
+            request.text += text
+            for stop in request.stop:
+                if stop in request.text:
+                    # Emit only what comes before the stop sequence
+                    end = request.text.index(stop)
+                    emitted = len(request.text) - len(text)
+                    if end > emitted:
+                        request.output.put(request.text[emitted:end])
+                    request.text = request.text[:end]
+                    self.finish(request)
+                    return
+            request.output.put(text)
+        if len(request.generated) >= request.max_tokens:
+            self.finish(request)
+            return
+        request.pending_tokens = [token]
+
+    def finish(self, request):
+        # Free the sequence's KV cells and its slot for the next waiting request
+        self.context.remove_sequence(request.seq_id)
+        request.finished = time.perf_counter()
+        request.output.put(None)
+        with self.condition:
+            self.active.pop(request.seq_id, None)
+            self.free_slots.append(request.seq_id)
+        self.completed.append(request)
+
+    def stats(self):
+        completed = list(self.completed)
+        if not completed:
+            return {"completed": 0}
+        waits = [request.started - request.submitted for request in completed]
+        first_tokens = [request.first_token - request.submitted for request in completed if request.first_token]
+        totals = [request.finished - request.submitted for request in completed]
+        rates = [len(request.generated) / (request.finished - request.started)
+                 for request in completed if request.finished > request.started and request.generated]
+        # Jain's fairness index over per-request decode rates, 1.0 means every request progressed equally
+        fairness = sum(rates) ** 2 / (len(rates) * sum(rate * rate for rate in rates)) if rates else None
+        return {
+            "completed": len(completed),
+            "active": len(self.active),
+            "waiting": len(self.waiting),
+            "tokens_per_second": self.generated_tokens / self.busy_time if self.busy_time else 0.0,
+            "mean_queue_wait": sum(waits) / len(waits),
+            "mean_time_to_first_token": sum(first_tokens) / len(first_tokens) if first_tokens else None,
+            "mean_total_time": sum(totals) / len(totals),
+            "fairness": fairness,
+        }
@@ -0,0 +1,214 @@
+import argparse
+import json
+import os
+import platform
+import resource
+import statistics
+import sys
+import tempfile
+import time
+
+from backends import create_chat_model, get_backend
+
+PROMPTS = [
+    "Write a short scene where two old friends meet at a train station.",
+    "Rewrite this line so it sounds more urgent: We should probably leave before the storm gets here.",
+    "Give me three title ideas for a mystery set in a lighthouse.",
+    "Summarize the plot of a heist story in two sentences.",
+]
+
+# Metrics where a larger value is an improvement, every other metric is better when smaller
+HIGHER_IS_BETTER = ("prompt_tokens_per_second", "decode_tokens_per_second")
+
+def peak_rss_mb(pid=None):
+    # High-water mark of resident memory, read from /proc where available
+    try:
+        with open("/proc/{}/status".format(pid or "self"), "r") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    if pid is not None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024
+
+def summarize(values):
+    values = [value for value in values if value is not None]
+    if not values:
+        return None
+    values = sorted(values)
+    return {
+        "mean": statistics.mean(values),
+        "p50": values[len(values) // 2],
+        "p95": values[min(len(values) - 1, int(0.95 * len(values)))],
+    }
+
+class Benchmark:
+    def __init__(self, model_path=None, chat_format="llama-2", runs=5, max_tokens=64, llama_options=None, backend=None):
+        # Without a model path the deterministic fake backend is used, so results are comparable across machines
+        self.fake = model_path is None
+        self.backend = "fake" if self.fake else get_backend(backend).name
+        self.chat_format = chat_format
+        self.runs = runs
+        self.max_tokens = max_tokens
+        self.llama_options = dict(llama_options or {})
+        # Holds the fake model file, removed by close()
+        self.temp_dir = None
+        if self.fake:
+            # ChatModel fingerprints the model file, so the fake model needs a file on disk
+            self.temp_dir = tempfile.TemporaryDirectory(prefix="scriptsage-bench-")
+            self.model_path = os.path.join(self.temp_dir.name, "fake.gguf")
+            with open(self.model_path, "wb") as f:
+                f.write(b"GGUF fake model for benchmarks")
+        else:
+            self.model_path = model_path
+        # Tokens are counted with the model's own vocabulary, without loading its weights
+        self.tokenizer = get_backend(self.backend).create_engine(self.model_path, chat_format, vocab_only=True,
+                                                                 **self.llama_options)
+        self.sampling_params = {"temperature": 0, "max_tokens": max_tokens}
+
+    def close(self):
+        if self.temp_dir is not None:
+            self.temp_dir.cleanup()
+            self.temp_dir = None
+
+    def count_tokens(self, text):
+        return len(self.tokenizer.tokenize(text.encode("utf-8"), add_bos=False))
+
+    def load_chat_model(self):
+        return create_chat_model(self.backend, self.model_path, self.chat_format, sampling_params=self.sampling_params,
+                                 llama_options=self.llama_options)
+
+    def load_worker(self):
+        return create_chat_model("subprocess", self.model_path, self.chat_format, sampling_params=self.sampling_params,
+                                 llama_options=self.llama_options, engine_backend=self.backend)
+
+    def run_prompt(self, model, prompt):
+        model.reset_conversation()
+        messages = [{"role": "user", "content": prompt}]
+        start = time.perf_counter()
+        arrivals = []
+        response = ""
+        for token in model.generate_response(prompt, stream=True):
+            arrivals.append(time.perf_counter())
+            response += token
+        end = time.perf_counter()
+        if not arrivals:
+            return None
+        time_to_first_token = arrivals[0] - start
+        # Prompt tokens are counted the way ChatModel budgets its context
+        prompt_tokens = sum(self.count_tokens(message["content"]) + 8 for message in messages)
+        completion_tokens = self.count_tokens(response)
+        decode_time = end - arrivals[0]
+        return {
+            "time_to_first_token": time_to_first_token,
+            "inter_token_latencies": [b - a for a, b in zip(arrivals, arrivals[1:])],
+            # The first token's decode is part of the time to first token
+            "prompt_tokens_per_second": prompt_tokens / time_to_first_token,
+            "decode_tokens_per_second": (completion_tokens - 1) / decode_time if decode_time > 0 and completion_tokens > 1 else None,
+        }
+
+    def run_scenario(self, name, load):
+        print("Running {} ({} runs)...".format(name, self.runs), file=sys.stderr)
+        start = time.perf_counter()
+        model = load()
+        load_time = time.perf_counter() - start
+        samples = []
+        try:
+            for i in range(self.runs):
+                # A different prefix per run keeps the prompt cache from skipping prompt evaluation
+                prompt = "Request {}. {}".format(i, PROMPTS[i % len(PROMPTS)])
+                sample = self.run_prompt(model, prompt)
+                if sample is not None:
+                    samples.append(sample)
+            # The worker's memory lives in its child process
+            rss = peak_rss_mb(model.process.pid) if hasattr(model, "process") else peak_rss_mb()
+        finally:
+            if hasattr(model, "close"):
+                model.close()
+        return {
+            "load_seconds": load_time,
+            "time_to_first_token": summarize([sample["time_to_first_token"] for sample in samples]),
+            "inter_token_latency": summarize([latency for sample in samples for latency in sample["inter_token_latencies"]]),
+            "prompt_tokens_per_second": summarize([sample["prompt_tokens_per_second"] for sample in samples]),
+            "decode_tokens_per_second": summarize([sample["decode_tokens_per_second"] for sample in samples]),
+            "peak_rss_mb": rss,
+        }
+
+    def run(self, scenarios=("chat_model", "worker")):
+        loaders = {"chat_model": self.load_chat_model, "worker": self.load_worker}
+        return {
+            "meta": {
+                "backend": self.backend,
+                "model": os.path.basename(self.model_path),
+                "host": platform.node(),
+                "python": platform.python_version(),
+                "runs": self.runs,
+                "max_tokens": self.max_tokens,
+                "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            },
+            "scenarios": {name: self.run_scenario(name, loaders[name]) for name in scenarios},
+        }
+
+def metric_value(metric):
+    # Distributions are compared on their median
+    return metric["p50"] if isinstance(metric, dict) else metric
+
+def compare(baseline, current, threshold=0.1):
+    # Relative change per metric, with the ones that got worse by more than threshold flagged
+    rows = []
+    for scenario, metrics in current["scenarios"].items():
+        for name, metric in metrics.items():
+            old = metric_value(baseline.get("scenarios", {}).get(scenario, {}).get(name))
+            new = metric_value(metric)
+            if old is None or new is None or old == 0:
+                continue
+            change = (new - old) / old
+            worse = -change if name in HIGHER_IS_BETTER else change
+            rows.append({"scenario": scenario, "metric": name, "baseline": old, "current": new,
+                         "change": change, "regression": worse > threshold})
+    return rows
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark ChatModel and the worker process with a fake or a real model.")
+    parser.add_argument("--model", help="GGUF model path, the deterministic fake backend is used when omitted")
+    parser.add_argument("--backend", help="backend for --model, llama_cpp by default or http with a llama-server URL as --model")
+    parser.add_argument("--chat-format", default="llama-2")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--max-tokens", type=int, default=64)
+    parser.add_argument("--scenario", action="append", choices=["chat_model", "worker"], help="defaults to both")
+    parser.add_argument("--output", default="bench_output.txt", help="JSON results file")
+    parser.add_argument("--compare", help="earlier results file to compare against")
+    parser.add_argument("--threshold", type=float, default=0.1, help="relative slowdown reported as a regression")
+    args = parser.parse_args()
+
+    benchmark = Benchmark(args.model, args.chat_format, args.runs, args.max_tokens, backend=args.backend)
+    try:
+        results = benchmark.run(args.scenario or ("chat_model", "worker"))
+    finally:
+        benchmark.close()
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+    print("Results written to", args.output, file=sys.stderr)
+
+    for scenario, metrics in results["scenarios"].items():
+        print(scenario)
+        for name, metric in metrics.items():
+            value = metric_value(metric)
+            print("  {:<26} {}".format(name, "-" if value is None else "{:.4f}".format(value)))
+
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        rows = compare(baseline, results, args.threshold)
+        for row in rows:
+            print("{scenario:<11} {metric:<26} {baseline:>10.4f} -> {current:>10.4f} ({change:+.1%}){flag}".format(
+                flag="  REGRESSION" if row["regression"] else "", **row))
+        if any(row["regression"] for row in rows):
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
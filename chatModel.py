@@ -1,25 +1,305 @@
-from llama_cpp import Llama
+import numpy as np
+
+from backends import get_backend
+from modelHash import model_fingerprint
+from semanticCache import SemanticCache
 
 class ChatModel:
-    def __init__(self, model_path, chat_format):
+    def __init__(self, model_path, chat_format, model_manager=None, cache_size=512 * 1024 * 1024, state_store=None,
+                 sampling_params=None, response_cache=None, semantic_threshold=None, semantic_capacity=1000,
+                 llama_options=None, speculative=None, backend=None, model_hash=None):
         self.model_path = model_path
         self.chat_format = chat_format
-        self.llm = Llama(model_path=model_path, chat_format=chat_format)
+        self.model_manager = model_manager
+        # Extra Llama constructor arguments such as n_threads, n_batch or n_ctx
+        self.llama_options = dict(llama_options or {})
+        # Registered backend that builds the engine, llama_cpp unless the model says otherwise
+        self.backend = get_backend(backend).name
+        self.cache_size = cache_size
+        # Extra arguments for create_chat_completion such as temperature or seed
+        self.sampling_params = dict(sampling_params or {})
+        # Repeated questions are answered from the cache when sampling is deterministic
+        self.response_cache = response_cache
+        # Conversation so far, sent with every question so the model keeps context
+        self.messages = []
+        # First message still sent to the model once the conversation outgrew the context window
+        self.context_start = 0
+        # Saved llama states let a past session continue without re-evaluating it
+        self.state_store = state_store
+        self.session_id = None
+        self.resume_pending = False
+        # Set by the caller to stop generating, it also aborts a prompt evaluation that is under way
+        self.abort_event = None
+        # Session whose state is in the KV cache but not on disk yet, it is saved once the context moves on
+        self.unsaved_session_id = None
+        self.unsaved_messages = None
+        # Speculative decoding drafts tokens with prompt lookup ("lookup") or a small draft GGUF (its path)
+        if speculative and not get_backend(self.backend).speculative:
+            print("The {} backend does not support speculative decoding, generating without it".format(self.backend))
+            speculative = None
+        self.speculative = speculative
+        self.draft = None
+        # Identity of the weights shared by every cache, the indexed content hash when the caller has one
+        self.model_hash = model_hash or model_fingerprint(model_path)
+        self.llm = self.get_llama(model_path, chat_format)
+        if speculative:
+            from speculative import SpeculativeDecoding
+            self.draft = SpeculativeDecoding.from_setting(speculative, n_ctx=self.llm.n_ctx())
+        # Optional cache that also answers paraphrases of earlier first questions
+        self.semantic_threshold = semantic_threshold
+        self.semantic_capacity = semantic_capacity
+        self.embedding_llm = None
+        self.semantic_cache = None
+        if semantic_threshold is not None:
+            self.load_semantic_cache()
+
+    def get_llama(self, model_path, chat_format):
+        llama_options = dict(self.llama_options)
+        if self.speculative:
+            # Verifying a draft needs the logits of every drafted position
+            llama_options["logits_all"] = True
+        # Reuse a resident instance from the model manager when one is available
+        if self.model_manager is not None:
+            llm = self.model_manager.get_model(model_path, chat_format, llama_options=llama_options, backend=self.backend,
+                                               model_hash=self.model_hash)
+        else:
+            llm = get_backend(self.backend).create_engine(model_path, chat_format, **llama_options)
+        if llm.cache is None:
+            # Snapshot the KV state after every reply so the next turn only evaluates the new tokens,
+            # even if another conversation used the same Llama in between
+            cache = get_backend(self.backend).create_cache(self.cache_size)
+            if cache is not None:
+                llm.set_cache(cache)
+        return llm
 
-    def load_model(self, model_path, chat_format):
-        self.llm = Llama(model_path=model_path, chat_format=chat_format)
+    def load_model(self, model_path, chat_format, model_hash=None):
+        self.model_hash = model_hash or model_fingerprint(model_path)
+        self.llm = self.get_llama(model_path, chat_format)
         self.model_path = model_path
         self.chat_format = chat_format
+        if self.semantic_threshold is not None:
+            self.load_semantic_cache()
+
+    def load_semantic_cache(self):
+        # Embeddings need a separate context created with embedding=True
+        if self.model_manager is not None:
+            self.embedding_llm = self.model_manager.get_model(self.model_path, self.chat_format, embedding=True,
+                                                              llama_options=self.llama_options, backend=self.backend,
+                                                              model_hash=self.model_hash)
+        else:
+            self.embedding_llm = get_backend(self.backend).create_engine(self.model_path, self.chat_format, embedding=True,
+                                                                         **self.llama_options)
+        self.semantic_cache = SemanticCache(model_hash=self.model_hash, capacity=self.semantic_capacity,
+                                            threshold=self.semantic_threshold)
+
+    def embed_prompt(self, messages):
+        # Only a fresh question can be answered semantically, follow-ups depend on the conversation
+        if self.semantic_cache is None or len(messages) != 1:
+            return None
+        embedding = np.asarray(self.embedding_llm.embed(messages[0]["content"]), dtype=np.float32)
+        if embedding.ndim == 2:
+            # Chat models usually have no pooling, so llama.cpp returns one vector per token. Their mean
+            # stands for the prompt, the first row alone is the BOS token and the same for every prompt
+            embedding = embedding.mean(axis=0)
+        return embedding
+
+    def reset_conversation(self, messages=None):
+        # Start a new conversation, optionally seeded with earlier messages
+        messages = list(messages or [])
+        # A conversation that only grew keeps its trim point, so its prompt still starts the same way
+        if messages[:len(self.messages)] != self.messages:
+            self.context_start = 0
+        self.messages = messages
+
+    def resume_session(self, session_id, messages):
+        # The saved state is loaded lazily on the generating thread before the next question
+        self.session_id = session_id
+        self.reset_conversation(messages)
+        self.resume_pending = True
+
+    def restore_session_state(self):
+        if not self.resume_pending:
+            return
+        self.resume_pending = False
+        if self.state_store is None or self.session_id is None or not get_backend(self.backend).stateful:
+            return
+        try:
+            saved = self.state_store.load(self.session_id, self.model_hash)
+            if saved is None:
+                return
+            state, messages = saved
+            offset = self.saved_offset(messages)
+            if offset is None:
+                # The saved state is of a different conversation than the one resumed, evaluate it afresh
+                return
+            self.llm.load_state(state)
+        except Exception as e:
+            # A state from another llama-cpp-python version or a damaged file, the prompt is evaluated as usual
+            print("Error occurred while restoring session state:", e)
+            if hasattr(self.llm, "reset"):
+                self.llm.reset()
+            return
+        # Keep the saved messages exactly as generated so they line up with the restored tokens,
+        # followed by any turns recorded after the save
+        self.messages = messages + self.messages[len(messages) - offset:]
+        print("Restored session state for session", self.session_id)
+
+    def saved_offset(self, saved):
+        # Position in the saved messages where the resumed conversation starts, or None if they disagree.
+        # The resumed conversation may be a window of the newest messages, so it can start after the first saved one
+        same = lambda a, b: a["role"] == b["role"] and a["content"].strip() == b["content"].strip()
+        for offset in range(len(saved)):
+            overlap = saved[offset:offset + len(self.messages)]
+            if all(same(a, b) for a, b in zip(overlap, self.messages)):
+                return offset
+        return 0 if not saved else None
+
+    def mark_session_unsaved(self):
+        if self.state_store is not None and self.session_id is not None and get_backend(self.backend).stateful:
+            self.unsaved_session_id = self.session_id
+            self.unsaved_messages = list(self.messages)
+
+    def save_session_state(self):
+        # Write the state of the last answered session. This runs before the context moves on to another
+        # conversation and on close, not after every reply, so answering never waits for it
+        if self.unsaved_session_id is None:
+            return
+        session_id, messages = self.unsaved_session_id, self.unsaved_messages
+        self.unsaved_session_id = self.unsaved_messages = None
+        try:
+            self.state_store.save(session_id, self.model_hash, self.llm.save_state(), messages)
+        except Exception as e:
+            print("Error occurred while saving session state:", e)
+
+    def close(self):
+        self.save_session_state()
+
+    def cache_stats(self):
+        # Hit counters of the response caches, None for a cache that is not in use
+        return {
+            "response_cache": self.response_cache.stats() if self.response_cache is not None else None,
+            "semantic_cache": self.semantic_cache.stats() if self.semantic_cache is not None else None,
+        }
+
+    def prepare_draft(self):
+        # Attach the drafter right before generating, a resident Llama may be shared with other chats
+        if self.draft is not None:
+            self.draft.reset()
+            self.llm.draft_model = self.draft
+
+    def prepare_abort(self):
+        # Attached right before generating like the drafter, so it checks this conversation's event
+        get_backend(self.backend).set_abort_callback(
+            self.llm, lambda: self.abort_event is not None and self.abort_event.is_set())
+
+    def speculative_stats(self):
+        return self.draft.stats() if self.draft is not None else None
+
+    def report_speculation(self):
+        stats = self.speculative_stats()
+        if stats and stats["acceptance_rate"] is not None:
+            print("Speculative decoding accepted {}/{} drafted tokens ({:.0%})".format(
+                stats["accepted_tokens"], stats["proposed_tokens"], stats["acceptance_rate"]))
+
+    def count_tokens(self, message):
+        return len(self.llm.tokenize(message["content"].encode("utf-8"), add_bos=False)) + 8
+
+    def fit_context(self, messages):
+        # Once the prompt would not leave room for the reply, drop the oldest turns down to half the window.
+        # The prompt then starts the same way for several turns, so the cached KV prefix keeps being reused
+        budget = self.llm.n_ctx() * 3 // 4
+        counts = [self.count_tokens(message) for message in messages]
+        start = min(self.context_start, len(messages) - 1)
+        if sum(counts[start:]) > budget:
+            while start < len(messages) - 1 and (sum(counts[start:]) > budget // 2 or messages[start]["role"] != "user"):
+                start += 1
+            self.context_start = start
+        return messages[start:]
+
+    def remember_turn(self, user_question, generated_response):
+        # Keep the reply exactly as generated so its tokens match the cached KV state
+        self.messages.append({"role": "user", "content": user_question})
+        self.messages.append({"role": "assistant", "content": generated_response})
+
+    def response_cache_key(self, messages):
+        if self.response_cache is None or not self.response_cache.is_deterministic(self.sampling_params):
+            return None
+        return self.response_cache.make_key(self.model_hash, self.chat_format, self.sampling_params, messages)
+
+    def cache_response(self, cache_key, generated_response, messages, embedding=None):
+        if cache_key is not None:
+            self.response_cache.put(cache_key, self.model_hash, self.chat_format, generated_response)
+        if embedding is not None:
+            self.semantic_cache.add(embedding, messages[-1]["content"], generated_response)
+
+    def generate_response(self, user_question, stream=False):
+        if self.unsaved_session_id is not None and (self.resume_pending or self.unsaved_session_id != self.session_id
+                                                    or self.messages != self.unsaved_messages):
+            self.save_session_state()
+        self.restore_session_state()
+        messages = self.fit_context(self.messages + [
+            {"role": "user", "content": user_question}
+        ])
+        cache_key = self.response_cache_key(messages)
+        cached_response = self.response_cache.get(cache_key) if cache_key is not None else None
+        embedding = self.embed_prompt(messages) if cached_response is None else None
+        if embedding is not None:
+            cached_response = self.semantic_cache.lookup(embedding)
+            if cached_response is not None:
+                embedding = None
+        if stream:
+            # Hand back a generator that yields the reply piece by piece
+            return self.stream_response(messages, cache_key, cached_response, embedding)
+
+        if cached_response is not None:
+            self.remember_turn(user_question, cached_response)
+            return cached_response
 
-    def generate_response(self, user_question):
         # Create a chat completion by providing messages
         print("Generating Response...Please Wait!!!")
-        response = self.llm.create_chat_completion(
-            messages=[
-                {"role": "user", "content": user_question}
-            ]
-        )
+        self.prepare_draft()
+        self.prepare_abort()
+        response = self.llm.create_chat_completion(messages=messages, **self.sampling_params)
+        self.report_speculation()
 
         # Extracting the generated response
         generated_response = response['choices'][0]['message']['content']
-        return generated_response
\ No newline at end of file
+        self.remember_turn(user_question, generated_response)
+        self.mark_session_unsaved()
+        self.cache_response(cache_key, generated_response, messages, embedding)
+        return generated_response
+
+    def stream_response(self, messages, cache_key=None, cached_response=None, embedding=None):
+        if cached_response is not None:
+            # A cached answer is delivered in one piece
+            self.remember_turn(messages[-1]["content"], cached_response)
+            yield cached_response
+            return
+
+        # Ask llama.cpp for a streamed completion so tokens arrive as they are decoded
+        print("Streaming Response...")
+        generated_response = ""
+        completed = failed = False
+        self.prepare_draft()
+        self.prepare_abort()
+        try:
+            for chunk in self.llm.create_chat_completion(messages=messages, stream=True, **self.sampling_params):
+                delta = chunk['choices'][0]['delta']
+                content = delta.get('content')
+                if content:
+                    generated_response += content
+                    yield content
+            completed = True
+        except Exception:
+            # Stopping during a llama.cpp call surfaces as an error, that is not a failure
+            failed = self.abort_event is None or not self.abort_event.is_set()
+            if failed:
+                raise
+        finally:
+            # A stopped reply stays in the conversation, the UI saves it as well
+            if completed or (not failed and generated_response.strip()):
+                self.remember_turn(messages[-1]["content"], generated_response)
+                self.mark_session_unsaved()
+        if completed:
+            self.report_speculation()
+            self.cache_response(cache_key, generated_response, messages, embedding)
@@ -0,0 +1,127 @@
+import argparse
+import os
+import platform
+import time
+
+from database import DatabaseManager
+
+def host_id():
+    # Tuning results only carry over to machines with the same name, architecture and core count
+    return "{}-{}-{}".format(platform.node(), platform.machine(), os.cpu_count())
+
+def thread_candidates(cpus=None):
+    cpus = cpus or (len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count() or 1)
+    # Physical cores are usually the sweet spot, hyperthreads and a few spare cores are worth trying too
+    candidates = {1, max(cpus // 4, 1), max(cpus // 2, 1), max(cpus * 3 // 4, 1), cpus}
+    return sorted(candidates)
+
+def tuning_options(tuning):
+    # Llama constructor arguments for a saved tuning result
+    if not tuning:
+        return {}
+    return {
+        "n_threads": tuning["n_threads"],
+        "n_threads_batch": tuning["n_threads"],
+        "n_batch": tuning["n_batch"],
+        "n_ctx": tuning["n_ctx"],
+    }
+
+class CpuTuner:
+    def __init__(self, model_path, db_manager=None, threads=None, batch_sizes=(128, 256, 512),
+                 context_sizes=(2048, 4096), prompt_tokens=256, decode_tokens=32, reply_tokens=256):
+        self.model_path = model_path
+        self.db_manager = db_manager
+        self.threads = list(threads or thread_candidates())
+        self.batch_sizes = list(batch_sizes)
+        self.context_sizes = sorted(context_sizes)
+        self.prompt_tokens = prompt_tokens
+        self.decode_tokens = decode_tokens
+        # A typical chat turn, used to weigh prompt evaluation against decoding
+        self.reply_tokens = reply_tokens
+        self.results = []
+
+    def measure(self, llm, n_threads):
+        import llama_cpp
+        llama_cpp.llama_set_n_threads(llm._ctx.ctx, n_threads, n_threads)
+        # The prompt is a repeated sentence, throughput does not depend on the text
+        text = "The quick brown fox jumps over the lazy dog. " * (self.prompt_tokens // 8 + 1)
+        tokens = llm.tokenize(text.encode("utf-8"))[:self.prompt_tokens]
+        llm.reset()
+        start = time.perf_counter()
+        llm.eval(tokens)
+        prompt_time = time.perf_counter() - start
+        start = time.perf_counter()
+        for _ in range(self.decode_tokens):
+            llm.eval([tokens[-1]])
+        decode_time = time.perf_counter() - start
+        return len(tokens) / prompt_time, self.decode_tokens / decode_time
+
+    def turn_time(self, result):
+        return self.prompt_tokens / result["prompt_tokens_per_second"] + \
+            self.reply_tokens / result["decode_tokens_per_second"]
+
+    def run(self, progress=None):
+        # Imported here so the app can read saved tunings without loading llama.cpp
+        from llama_cpp import Llama
+        # Threads are switched on a loaded context, batch and context sizes need a fresh one
+        configs = [(n_batch, self.context_sizes[0]) for n_batch in self.batch_sizes]
+        steps = len(configs) * len(self.threads) + len(self.context_sizes) - 1
+        done = 0
+        for n_batch, n_ctx in configs:
+            llm = Llama(model_path=self.model_path, n_batch=n_batch, n_ctx=n_ctx, verbose=False)
+            # Warm up so the first measurement does not pay for page faults on the weights
+            self.measure(llm, self.threads[-1])
+            for n_threads in self.threads:
+                prompt_rate, decode_rate = self.measure(llm, n_threads)
+                self.results.append({
+                    "n_threads": n_threads, "n_batch": n_batch, "n_ctx": n_ctx,
+                    "prompt_tokens_per_second": prompt_rate, "decode_tokens_per_second": decode_rate,
+                })
+                done += 1
+                if progress:
+                    progress(done * 100 // steps)
+            del llm
+        best = min(self.results, key=self.turn_time)
+
+        # Take the largest context that loads and keeps decoding within 10% of the best
+        for n_ctx in self.context_sizes[1:]:
+            try:
+                llm = Llama(model_path=self.model_path, n_batch=best["n_batch"], n_ctx=n_ctx, verbose=False)
+                prompt_rate, decode_rate = self.measure(llm, best["n_threads"])
+                del llm
+            except Exception as e:
+                print("Error occurred while trying context size {}: {}".format(n_ctx, e))
+                break
+            done += 1
+            if progress:
+                progress(done * 100 // steps)
+            if decode_rate < best["decode_tokens_per_second"] * 0.9:
+                break
+            best = dict(best, n_ctx=n_ctx)
+
+        if self.db_manager is not None:
+            self.db_manager.save_model_tuning(self.model_path, host_id(), best)
+        return best
+
+def main():
+    parser = argparse.ArgumentParser(description="Find the fastest n_threads, n_batch and n_ctx for a model on this machine.")
+    parser.add_argument("--model", help="GGUF model path, defaults to the active model in the app database")
+    parser.add_argument("--threads", type=int, nargs="+", help="thread counts to try")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[128, 256, 512])
+    parser.add_argument("--context-sizes", type=int, nargs="+", default=[2048, 4096])
+    args = parser.parse_args()
+
+    db_manager = DatabaseManager()
+    db_manager.create_database()
+    model_path = args.model or db_manager.get_active_model_path()
+    if not model_path:
+        parser.error("no --model given and no active model found")
+    tuner = CpuTuner(model_path, db_manager, args.threads, args.batch_sizes, args.context_sizes)
+    best = tuner.run(progress=lambda percent: print("Tuning... {}%".format(percent)))
+    for result in tuner.results:
+        print("threads {n_threads:>3} batch {n_batch:>4} ctx {n_ctx:>5}: prompt {prompt_tokens_per_second:8.1f} tok/s, "
+              "decode {decode_tokens_per_second:6.1f} tok/s".format(**result))
+    print("Saved for {}: threads {n_threads}, batch {n_batch}, ctx {n_ctx}".format(host_id(), **best))
+
+if __name__ == "__main__":
+    main()
@@ -1,90 +1,284 @@
 import sqlite3
 import datetime
+import os
+import threading
+
+# Model columns added between the first release and schema versioning, later columns get their own migration
+MODEL_COLUMNS = [
+    ("backend", "TEXT DEFAULT 'llama_cpp'"),
+    ("architecture", "TEXT"),
+    ("context_length", "INTEGER"),
+    ("quantization", "TEXT"),
+    ("parameter_count", "INTEGER"),
+    ("chat_template", "TEXT"),
+    ("chat_format", "TEXT"),
+    ("file_size", "INTEGER"),
+    ("file_mtime", "REAL"),
+    ("source_dir", "TEXT"),
+    ("content_hash", "TEXT"),
+    ("hash_progress", "TEXT"),
+    ("duplicate_of", "TEXT"),
+    ("speculative", "TEXT"),
+]
+
+# GGUF header fields cached on the Model row
+MODEL_METADATA = ["architecture", "context_length", "quantization", "parameter_count", "chat_template", "chat_format"]
+
+# Characters of a session's first message kept for the history page
+SUMMARY_PREVIEW = 200
+
+def add_model_columns(cursor):
+    # Databases from before versioning may already have some of these columns
+    cursor.execute("PRAGMA table_info(Model)")
+    existing = [column[1] for column in cursor.fetchall()]
+    for name, definition in MODEL_COLUMNS:
+        if name not in existing:
+            cursor.execute("ALTER TABLE Model ADD COLUMN {} {}".format(name, definition))
+
+# Schema changes in order, each a list of statements or a function taking a cursor. The database records how many
+# have run in PRAGMA user_version, so new changes are appended here and existing ones are never edited.
+# The early ones use IF NOT EXISTS because databases from before versioning start at version 0
+MIGRATIONS = [
+    # 1: tables of the first release
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS Model (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT UNIQUE,
+            path TEXT,
+            isactive INTEGER DEFAULT 0
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS ChatSession (
+            session_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            session_date TEXT,
+            session_time TEXT
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS Message (
+            message_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            session_id INTEGER,
+            sender TEXT,
+            message_text TEXT,
+            timestamp TEXT,
+            FOREIGN KEY (session_id) REFERENCES ChatSession(session_id)
+        )
+        ''',
+    ],
+    # 2: backend, GGUF header, scan and content hash columns on Model
+    add_model_columns,
+    # 3: answers to repeated deterministic prompts
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS ResponseCache (
+            cache_key TEXT PRIMARY KEY,
+            model_hash TEXT,
+            chat_format TEXT,
+            response TEXT,
+            size INTEGER,
+            hits INTEGER DEFAULT 0,
+            created REAL,
+            last_used REAL
+        )
+        ''',
+        "CREATE INDEX IF NOT EXISTS idx_response_cache_last_used ON ResponseCache (last_used)",
+    ],
+    # 4: fastest llama.cpp settings per model and host
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS ModelTuning (
+            model_path TEXT,
+            host TEXT,
+            n_threads INTEGER,
+            n_batch INTEGER,
+            n_ctx INTEGER,
+            prompt_tokens_per_second REAL,
+            decode_tokens_per_second REAL,
+            tuned_at TEXT,
+            PRIMARY KEY (model_path, host)
+        )
+        ''',
+    ],
+    # 5: folders scanned for new models
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS ModelDirectory (
+            path TEXT PRIMARY KEY
+        )
+        ''',
+    ],
+    # 6: indexes for loading a session, finding today's session and the active model
+    [
+        # Messages of a session in order, also answers MIN(message_id) per session without touching the table
+        "CREATE INDEX IF NOT EXISTS idx_message_session ON Message (session_id, message_id)",
+        "CREATE INDEX IF NOT EXISTS idx_chat_session_date ON ChatSession (session_date, session_id)",
+        "CREATE INDEX IF NOT EXISTS idx_model_active ON Model (isactive, name, path)",
+    ],
+    # 7: per-session summary for the history page, kept up to date by a trigger on every message insert.
+    # Tokens are estimated at four characters each, the database has no tokenizer
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS SessionSummary (
+            session_id INTEGER PRIMARY KEY,
+            first_message TEXT,
+            message_count INTEGER DEFAULT 0,
+            last_activity TEXT,
+            token_count INTEGER DEFAULT 0
+        )
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_message_session_summary AFTER INSERT ON Message
+        BEGIN
+            INSERT OR IGNORE INTO SessionSummary (session_id, first_message)
+            VALUES (NEW.session_id, substr(NEW.message_text, 1, {preview}));
+            UPDATE SessionSummary
+            SET message_count = message_count + 1,
+                last_activity = NEW.timestamp,
+                token_count = token_count + (length(NEW.message_text) + 3) / 4
+            WHERE session_id = NEW.session_id;
+        END
+        '''.format(preview=SUMMARY_PREVIEW),
+        # Summarize the messages saved before the trigger existed
+        '''
+        INSERT OR REPLACE INTO SessionSummary (session_id, first_message, message_count, last_activity, token_count)
+        SELECT totals.session_id, substr(first.message_text, 1, {preview}), totals.message_count, last.timestamp,
+               totals.token_count
+        FROM (
+            SELECT session_id, MIN(message_id) AS first_id, MAX(message_id) AS last_id, COUNT(*) AS message_count,
+                   SUM((length(message_text) + 3) / 4) AS token_count
+            FROM Message
+            GROUP BY session_id
+        ) totals
+        JOIN Message first ON first.message_id = totals.first_id
+        JOIN Message last ON last.message_id = totals.last_id
+        '''.format(preview=SUMMARY_PREVIEW),
+    ],
+    # 8: per-model speculative decoding setting, "lookup" or a draft GGUF path
+    add_model_columns,
+]
+SCHEMA_VERSION = len(MIGRATIONS)
 
 class DatabaseManager:
     def __init__(self, db_name='DB.db'):
         self.db_name = db_name
+        # Each thread keeps one open connection, so prepared statements and the page cache survive between calls
+        self.local = threading.local()
+        self.connections = []
+        self.lock = threading.Lock()
 
-    def create_database(self):
-        # Connect to the SQLite database or create it if it doesn't exist
-        conn = sqlite3.connect(self.db_name)
-        cursor = conn.cursor()
-
-        # Create the Model table if it doesn't exist
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS Model (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name TEXT UNIQUE,
-                path TEXT,
-                isactive INTEGER DEFAULT 0
-            )
-        ''')
-
-        # Create the ChatSession table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS ChatSession (
-                session_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                session_date TEXT,
-                session_time TEXT
-                -- Add other session-related columns as needed
-            )
-        ''')
-
-        # Create the Message table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS Message (
-                message_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                session_id INTEGER,
-                sender TEXT,
-                message_text TEXT,
-                timestamp TEXT,
-                FOREIGN KEY (session_id) REFERENCES ChatSession(session_id)
-            )
-        ''')
-
-        # Commit the changes and close the connection
-        conn.commit()
+    def connect(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            # check_same_thread is off only so close() can shut every thread's connection down
+            conn = sqlite3.connect(self.db_name, timeout=5, check_same_thread=False, cached_statements=256)
+            # WAL lets readers run alongside a writer, and with synchronous=NORMAL a commit no longer waits for fsync
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA cache_size=-16000")
+            conn.execute("PRAGMA temp_store=MEMORY")
+            self.local.conn = conn
+            with self.lock:
+                self.connections.append(conn)
+        return conn
+
+    def release(self, conn):
+        # A method that failed before committing leaves its changes behind, roll them back like a closed connection would
+        if conn.in_transaction:
+            conn.rollback()
+
+    def close_thread_connection(self):
+        # Called by short-lived threads when they finish, close() only reaches connections of threads still around
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            return
+        self.local.conn = None
+        with self.lock:
+            if conn in self.connections:
+                self.connections.remove(conn)
         conn.close()
+
+    def close(self):
+        with self.lock:
+            connections, self.connections = self.connections, []
+        for conn in connections:
+            conn.close()
+        self.local = threading.local()
+
+    def create_database(self):
+        # Bring the schema up to SCHEMA_VERSION, a current database costs one PRAGMA read and no DDL
+        conn = self.connect()
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        if version >= SCHEMA_VERSION:
+            return
+        try:
+            for number, migration in enumerate(MIGRATIONS[version:], version + 1):
+                # IMMEDIATE takes the write lock first, so two processes starting together do not both migrate
+                conn.execute("BEGIN IMMEDIATE")
+                if conn.execute("PRAGMA user_version").fetchone()[0] >= number:
+                    conn.rollback()
+                    continue
+                cursor = conn.cursor()
+                if callable(migration):
+                    migration(cursor)
+                else:
+                    for statement in migration:
+                        cursor.execute(statement)
+                cursor.execute("PRAGMA user_version = {}".format(number))
+                conn.commit()
+        except sqlite3.Error as e:
+            print("Error occurred while migrating database:", e)
+        finally:
+            self.release(conn)
+
     def fetch_chat_history(self):
+        # One row per session with messages: date, first message, id, message count, last activity and tokens.
+        # Read from SessionSummary, so the cost follows the number of sessions, not messages
+        conn = self.connect()
+        cursor = conn.cursor()
         try:
-            conn = sqlite3.connect(self.db_name)
-            cursor = conn.cursor()
             cursor.execute("""
-                SELECT cs.session_date, m.message_text,mm.session_id
-                FROM ChatSession cs 
-                LEFT JOIN (
-                    SELECT session_id, MIN(message_id) as min_message_id 
-                    FROM Message 
-                    GROUP BY session_id
-                ) mm ON cs.session_id = mm.session_id 
-                LEFT JOIN Message m ON mm.min_message_id = m.message_id
+                SELECT cs.session_date, ss.first_message, ss.session_id, ss.message_count, ss.last_activity, ss.token_count
+                FROM SessionSummary ss
+                JOIN ChatSession cs ON cs.session_id = ss.session_id
+                ORDER BY ss.session_id
             """)
             chat_history = cursor.fetchall()
             return chat_history
         except sqlite3.Error as e:
             print("Error occurred while fetching chat history:", e)
             return []
+        finally:
+            self.release(conn)
 
-    def insert_model_into_database(self, name, path):
+    def insert_model_into_database(self, name, path, backend="llama_cpp", metadata=None):
         # Connect to the SQLite database
-        conn = sqlite3.connect(self.db_name)
+        conn = self.connect()
         cursor = conn.cursor()
 
         try:
             # Insert the data into the Model table
-            cursor.execute('INSERT INTO Model (name, path, isactive) VALUES (?, ?, 0)', (name, path))
+            metadata = metadata or {}
+            cursor.execute('''
+                INSERT INTO Model (name, path, isactive, backend, {})
+                VALUES (?, ?, 0, ?, {})
+            '''.format(", ".join(MODEL_METADATA), ", ".join("?" * len(MODEL_METADATA))),
+                (name, path, backend) + tuple(metadata.get(key) for key in MODEL_METADATA))
             conn.commit()
             print("Model inserted successfully!")
         except sqlite3.Error as e:
             print("Error occurred while inserting model:", e)
         finally:
-            # Close the connection
-            conn.close()
+            # Hand the connection back
+            self.release(conn)
     def fetch_all_models(self):
         # Connect to the SQLite database
-        conn = sqlite3.connect(self.db_name)
+        conn = self.connect()
         cursor = conn.cursor()
 
+        # Rows also index by column name, for the columns added after the first four
+        cursor.row_factory = sqlite3.Row
         try:
             # Fetch all rows from the Model table
             cursor.execute('SELECT * FROM Model')
@@ -94,11 +288,11 @@ class DatabaseManager:
             print("Error occurred while fetching models:", e)
             return None
         finally:
-            # Close the connection
-            conn.close()
+            # Hand the connection back
+            self.release(conn)
     def remove_model(self, model_name):
             # Connect to the SQLite database
-            conn = sqlite3.connect(self.db_name)
+            conn = self.connect()
             cursor = conn.cursor()
 
             try:
@@ -109,10 +303,10 @@ class DatabaseManager:
             except sqlite3.Error as e:
                 print("Error occurred while removing model:", e)
             finally:
-                # Close the connection
-                conn.close()
+                # Hand the connection back
+                self.release(conn)
     def update_all_models_inactive(self):
-        conn = sqlite3.connect(self.db_name)
+        conn = self.connect()
         cursor = conn.cursor()
         try:
             cursor.execute("UPDATE Model SET isactive = 0")
@@ -120,10 +314,10 @@ class DatabaseManager:
         except sqlite3.Error as e:
             print("Error occurred while updating models:", e)
         finally:
-            conn.close()
+            self.release(conn)
 
     def set_model_active(self, model_name):
-        conn = sqlite3.connect(self.db_name)
+        conn = self.connect()
         cursor = conn.cursor()
         try:
             cursor.execute("UPDATE Model SET isactive = 1 WHERE name = ?", (model_name,))
@@ -131,9 +325,9 @@ class DatabaseManager:
         except sqlite3.Error as e:
             print("Error occurred while setting model active:", e)
         finally:
-            conn.close()
+            self.release(conn)
     def get_active_model_path(self):
-        conn = sqlite3.connect(self.db_name)
+        conn = self.connect()
         cursor = conn.cursor()
         try:
             cursor.execute("SELECT path FROM Model WHERE isactive = 1")
@@ -143,9 +337,9 @@ class DatabaseManager:
         except sqlite3.Error as e:
             print("Error occurred while fetching active model path:", e)
         finally:
-            conn.close()
+            self.release(conn)
     def get_active_model_name(self):
-        conn = sqlite3.connect(self.db_name)
+        conn = self.connect()
         cursor = conn.cursor()
         try:
             cursor.execute("SELECT name FROM Model WHERE isactive = 1")
@@ -155,10 +349,249 @@ class DatabaseManager:
         except sqlite3.Error as e:
             print("Error occurred while fetching active model path:", e)
         finally:
-            conn.close()
+            self.release(conn)
+    def get_model_backend(self, model_path):
+        conn = self.connect()
+        cursor = conn.cursor()
+        try:
+            cursor.execute("SELECT backend FROM Model WHERE path = ?", (model_path,))
+            result = cursor.fetchone()
+            if result:
+                return result[0]
+        except sqlite3.Error as e:
+            print("Error occurred while fetching model backend:", e)
+        finally:
+            self.release(conn)
+
+    def get_model_metadata(self, model_path):
+        # Returns the cached GGUF header fields, or None when the file has not been indexed yet
+        conn = self.connect()
+        cursor = conn.cursor()
+        try:
+            cursor.execute("SELECT {} FROM Model WHERE path = ?".format(", ".join(MODEL_METADATA)), (model_path,))
+            result = cursor.fetchone()
+            if result and result[MODEL_METADATA.index("parameter_count")] is not None:
+                return dict(zip(MODEL_METADATA, result))
+        except sqlite3.Error as e:
+            print("Error occurred while fetching model metadata:", e)
+        finally:
+            self.release(conn)
+
+    def update_model_metadata(self, model_path, metadata):
+        conn = self.connect()
+        cursor = conn.cursor()
+        try:
+            cursor.execute("UPDATE Model SET {} WHERE path = ?".format(", ".join(key + " = ?" for key in MODEL_METADATA)),
+                           tuple(metadata.get(key) for key in MODEL_METADATA) + (model_path,))
+            conn.commit()
+        except sqlite3.Error as e:
+            print("Error occurred while updating model metadata:", e)
+        finally:
+            self.release(conn)
+
+    def fetch_watched_directories(self):
+        conn = self.connect()
+        cursor = conn.cursor()
+        try:
+            cursor.execute("SELECT path FROM ModelDirectory")
+            return [row[0] for row in cursor.fetchall()]
+        except sqlite3.Error as e:
+            print("Error occurred while fetching model directories:", e)
+            return []
+        finally:
+            self.release(conn)
+
+    def add_watched_directory(self, path):
+        conn = self.connect()
+        cursor = conn.cursor()
+        try:
+            cursor.execute("INSERT OR IGNORE INTO ModelDirectory (path) VALUES (?)", (path,))
+            conn.commit()
+        except sqlite3.Error as e:
+            print("Error occurred while adding model directory:", e)
+        finally:
+            self.release(conn)
+
+    def remove_watched_directory(self, path):
+        conn = self.connect()
+        cursor = conn.cursor()
+        try:
+            cursor.execute("DELETE FROM ModelDirectory WHERE path = ?", (path,))
+            conn.commit()
+        except sqlite3.Error as e:
+            print("Error occurred while removing model directory:", e)
+        finally:
+            self.release(conn)
+
+    def fetch_model_files(self):
+        # (size, mtime, source_dir) of every registered model file, keyed by path
+        conn = self.connect()
+        cursor = conn.cursor()
+        try:
+            cursor.execute("SELECT path, file_size, file_mtime, source_dir FROM Model")
+            return {row[0]: row[1:] for row in cursor.fetchall()}
+        except sqlite3.Error as e:
+            print("Error occurred while fetching model files:", e)
+            return {}
+        finally:
+            self.release(conn)
+
+    def apply_model_scan(self, added, updated, removed):
+        # Apply one batch of scanner results in a single transaction and return the rows that changed.
+        # added and updated hold (path, size, mtime, source_dir, metadata), removed holds paths
+        conn = self.connect()
+        cursor = conn.cursor()
+        try:
+            cursor.execute("SELECT name FROM Model")
+            names = {row[0] for row in cursor.fetchall()}
+            columns = ", ".join(MODEL_METADATA)
+            for path, size, mtime, source_dir, metadata in added:
+                # Names are unique, the same file name in another folder gets the folder added
+                name = os.path.basename(path)
+                if name in names:
+                    name = "{} ({})".format(name, os.path.basename(os.path.dirname(path)))
+                names.add(name)
+                cursor.execute('''
+                    INSERT OR IGNORE INTO Model (name, path, isactive, file_size, file_mtime, source_dir, {})
+                    VALUES (?, ?, 0, ?, ?, ?, {})
+                '''.format(columns, ", ".join("?" * len(MODEL_METADATA))),
+                    (name, path, size, mtime, source_dir) + tuple(metadata.get(key) for key in MODEL_METADATA))
+            for path, size, mtime, source_dir, metadata in updated:
+                # A changed file needs hashing again
+                cursor.execute("UPDATE Model SET file_size = ?, file_mtime = ?, content_hash = NULL, hash_progress = NULL, "
+                               "duplicate_of = NULL, {} WHERE path = ?".format(
+                    ", ".join(key + " = ?" for key in MODEL_METADATA)),
+                    (size, mtime) + tuple(metadata.get(key) for key in MODEL_METADATA) + (path,))
+            cursor.executemany("DELETE FROM Model WHERE path = ?", [(path,) for path in removed])
+            conn.commit()
+            changed = [path for path, *_ in added + updated]
+            cursor.row_factory = sqlite3.Row
+            cursor.execute("SELECT * FROM Model WHERE path IN ({})".format(", ".join("?" * len(changed))), changed)
+            return cursor.fetchall()
+        except sqlite3.Error as e:
+            conn.rollback()
+            print("Error occurred while saving scanned models:", e)
+            return []
+        finally:
+            self.release(conn)
+
+    def fetch_unhashed_models(self):
+        conn = self.connect()
+        cursor = conn.cursor()
+        try:
+            cursor.execute("SELECT path FROM Model WHERE content_hash IS NULL")
+            return [row[0] for row in cursor.fetchall()]
+        except sqlite3.Error as e:
+            print("Error occurred while fetching unhashed models:", e)
+            return []
+        finally:
+            self.release(conn)
+
+    def get_hash_progress(self, model_path):
+        conn = self.connect()
+        cursor = conn.cursor()
+        try:
+            cursor.execute("SELECT hash_progress FROM Model WHERE path = ?", (model_path,))
+            result = cursor.fetchone()
+            if result:
+                return result[0]
+        except sqlite3.Error as e:
+            print("Error occurred while fetching hash progress:", e)
+        finally:
+            self.release(conn)
+
+    def save_hash_progress(self, model_path, progress):
+        conn = self.connect()
+        cursor = conn.cursor()
+        try:
+            cursor.execute("UPDATE Model SET hash_progress = ? WHERE path = ?", (progress, model_path))
+            conn.commit()
+        except sqlite3.Error as e:
+            print("Error occurred while saving hash progress:", e)
+        finally:
+            self.release(conn)
+
+    def get_model_hash(self, model_path):
+        conn = self.connect()
+        cursor = conn.cursor()
+        try:
+            cursor.execute("SELECT content_hash FROM Model WHERE path = ?", (model_path,))
+            result = cursor.fetchone()
+            if result:
+                return result[0]
+        except sqlite3.Error as e:
+            print("Error occurred while fetching model hash:", e)
+        finally:
+            self.release(conn)
+
+    def fetch_model(self, model_path):
+        conn = self.connect()
+        cursor = conn.cursor()
+        cursor.row_factory = sqlite3.Row
+        try:
+            cursor.execute("SELECT * FROM Model WHERE path = ?", (model_path,))
+            return cursor.fetchone()
+        except sqlite3.Error as e:
+            print("Error occurred while fetching model:", e)
+            return None
+        finally:
+            self.release(conn)
+
+    def save_model_hash(self, model_path, content_hash):
+        # Store the content hash and return the name of another model with the same content, if any
+        conn = self.connect()
+        cursor = conn.cursor()
+        try:
+            # Lookup and update under one write lock, so two copies hashed at the same time still find each other
+            conn.execute("BEGIN IMMEDIATE")
+            cursor.execute("SELECT MIN(name) FROM Model WHERE content_hash = ? AND path != ?", (content_hash, model_path))
+            duplicate_of = cursor.fetchone()[0]
+            cursor.execute("UPDATE Model SET content_hash = ?, hash_progress = NULL, duplicate_of = ? WHERE path = ?",
+                           (content_hash, duplicate_of, model_path))
+            conn.commit()
+            return duplicate_of
+        except sqlite3.Error as e:
+            print("Error occurred while saving model hash:", e)
+        finally:
+            self.release(conn)
+
+    def set_model_backend(self, model_name, backend):
+        conn = self.connect()
+        cursor = conn.cursor()
+        try:
+            cursor.execute("UPDATE Model SET backend = ? WHERE name = ?", (backend, model_name))
+            conn.commit()
+        except sqlite3.Error as e:
+            print("Error occurred while setting model backend:", e)
+        finally:
+            self.release(conn)
+    def get_model_speculative(self, model_path):
+        conn = self.connect()
+        cursor = conn.cursor()
+        try:
+            cursor.execute("SELECT speculative FROM Model WHERE path = ?", (model_path,))
+            result = cursor.fetchone()
+            if result:
+                return result[0]
+        except sqlite3.Error as e:
+            print("Error occurred while fetching speculative setting:", e)
+        finally:
+            self.release(conn)
+
+    def set_model_speculative(self, model_name, speculative):
+        conn = self.connect()
+        cursor = conn.cursor()
+        try:
+            cursor.execute("UPDATE Model SET speculative = ? WHERE name = ?", (speculative, model_name))
+            conn.commit()
+        except sqlite3.Error as e:
+            print("Error occurred while setting speculative setting:", e)
+        finally:
+            self.release(conn)
+
     def is_any_model_active(self):
         # Connect to the SQLite database
-        conn = sqlite3.connect(self.db_name)
+        conn = self.connect()
         cursor = conn.cursor()
 
         try:
@@ -170,15 +603,15 @@ class DatabaseManager:
             print("Error occurred while checking for active models:", e)
             return False
         finally:
-            # Close the connection
-            conn.close()
+            # Hand the connection back
+            self.release(conn)
     def get_or_create_session_id(self):
         # Get today's date and time
         today_date = datetime.datetime.today().strftime('%Y-%m-%d')
         current_time = datetime.datetime.now().strftime('%H:%M:%S')
 
         # Connect to the SQLite database
-        conn = sqlite3.connect(self.db_name)
+        conn = self.connect()
         cursor = conn.cursor()
 
         try:
@@ -198,12 +631,12 @@ class DatabaseManager:
             print("Error occurred while fetching or creating session ID:", e)
             return None
         finally:
-            # Close the connection
-            conn.close()
+            # Hand the connection back
+            self.release(conn)
 
     def save_message(self, session_id, sender, message_text, timestamp):
         # Connect to the SQLite database
-        conn = sqlite3.connect(self.db_name)
+        conn = self.connect()
         cursor = conn.cursor()
 
         try:
@@ -217,18 +650,155 @@ class DatabaseManager:
         except sqlite3.Error as e:
             print("Error occurred while saving message:", e)
         finally:
-            # Close the connection
-            conn.close()
-    def fetch_messages_by_session_id(self, session_id):
+            # Hand the connection back
+            self.release(conn)
+    def save_messages(self, messages):
+        # Insert (session_id, sender, message_text, timestamp) rows in one transaction
+        conn = self.connect()
+        cursor = conn.cursor()
         try:
-            conn = sqlite3.connect(self.db_name)
-            cursor = conn.cursor()
-            cursor.execute("SELECT sender, message_text, timestamp FROM Message WHERE session_id = ?", (session_id,))
-            messages = cursor.fetchall()
-            return messages
+            cursor.executemany('''
+                INSERT INTO Message (session_id, sender, message_text, timestamp)
+                VALUES (?, ?, ?, ?)
+            ''', messages)
+            conn.commit()
         except sqlite3.Error as e:
-            print("Error occurred while fetching messages by session ID:", e)
+            print("Error occurred while saving messages:", e)
+        finally:
+            self.release(conn)
+
+    def checkpoint(self):
+        # Copy committed WAL pages into the database file and sync it. Commits under synchronous=NORMAL
+        # survive an app crash, only a checkpoint makes them survive a power loss
+        conn = self.connect()
+        try:
+            conn.execute("PRAGMA wal_checkpoint(FULL)")
+        except sqlite3.Error as e:
+            print("Error occurred while checkpointing database:", e)
+        finally:
+            self.release(conn)
+
+    def fetch_messages_page(self, session_id, before_id=None, limit=50):
+        # The newest limit messages of a session older than message before_id, oldest first, as
+        # (message_id, sender, message_text, timestamp). Pass the first id of a page to get the one before it.
+        # Each page is a seek on idx_message_session, so its cost does not grow with the session
+        conn = self.connect()
+        cursor = conn.cursor()
+        try:
+            if before_id is None:
+                cursor.execute("""
+                    SELECT message_id, sender, message_text, timestamp FROM Message
+                    WHERE session_id = ? ORDER BY message_id DESC LIMIT ?
+                """, (session_id, limit))
+            else:
+                cursor.execute("""
+                    SELECT message_id, sender, message_text, timestamp FROM Message
+                    WHERE session_id = ? AND message_id < ? ORDER BY message_id DESC LIMIT ?
+                """, (session_id, before_id, limit))
+            return cursor.fetchall()[::-1]
+        except sqlite3.Error as e:
+            print("Error occurred while fetching messages page:", e)
             return []
+        finally:
+            self.release(conn)
+
+    def get_cached_response(self, cache_key, now):
+        conn = self.connect()
+        cursor = conn.cursor()
+        try:
+            cursor.execute("SELECT response FROM ResponseCache WHERE cache_key = ?", (cache_key,))
+            result = cursor.fetchone()
+            if result:
+                # Record the hit so eviction keeps frequently asked answers
+                cursor.execute("UPDATE ResponseCache SET hits = hits + 1, last_used = ? WHERE cache_key = ?", (now, cache_key))
+                conn.commit()
+                return result[0]
+        except sqlite3.Error as e:
+            print("Error occurred while reading response cache:", e)
+        finally:
+            self.release(conn)
+
+    def save_cached_response(self, cache_key, model_hash, chat_format, response, now, max_entries, max_bytes):
+        conn = self.connect()
+        cursor = conn.cursor()
+        try:
+            cursor.execute('''
+                INSERT OR REPLACE INTO ResponseCache (cache_key, model_hash, chat_format, response, size, hits, created, last_used)
+                VALUES (?, ?, ?, ?, ?, 0, ?, ?)
+            ''', (cache_key, model_hash, chat_format, response, len(response.encode("utf-8")), now, now))
+
+            # Evict the least recently used entries beyond the count and size limits
+            cursor.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM ResponseCache")
+            count, total = cursor.fetchone()
+            if count > max_entries or total > max_bytes:
+                cursor.execute("SELECT cache_key, size FROM ResponseCache ORDER BY last_used")
+                evicted = []
+                for key, size in cursor.fetchall():
+                    if count <= max_entries and total <= max_bytes:
+                        break
+                    evicted.append((key,))
+                    count -= 1
+                    total -= size
+                cursor.executemany("DELETE FROM ResponseCache WHERE cache_key = ?", evicted)
+            conn.commit()
+        except sqlite3.Error as e:
+            print("Error occurred while saving response cache:", e)
+        finally:
+            self.release(conn)
+
+    def clear_response_cache(self, model_hash=None):
+        conn = self.connect()
+        cursor = conn.cursor()
+        try:
+            if model_hash is None:
+                cursor.execute("DELETE FROM ResponseCache")
+            else:
+                cursor.execute("DELETE FROM ResponseCache WHERE model_hash = ?", (model_hash,))
+            conn.commit()
+        except sqlite3.Error as e:
+            print("Error occurred while clearing response cache:", e)
+        finally:
+            self.release(conn)
+
+    def get_model_tuning(self, model_path, host):
+        conn = self.connect()
+        cursor = conn.cursor()
+        try:
+            cursor.execute("""
+                SELECT n_threads, n_batch, n_ctx, prompt_tokens_per_second, decode_tokens_per_second
+                FROM ModelTuning WHERE model_path = ? AND host = ?
+            """, (model_path, host))
+            result = cursor.fetchone()
+            if result:
+                return {
+                    "n_threads": result[0],
+                    "n_batch": result[1],
+                    "n_ctx": result[2],
+                    "prompt_tokens_per_second": result[3],
+                    "decode_tokens_per_second": result[4],
+                }
+        except sqlite3.Error as e:
+            print("Error occurred while reading model tuning:", e)
+        finally:
+            self.release(conn)
+
+    def save_model_tuning(self, model_path, host, tuning):
+        conn = self.connect()
+        cursor = conn.cursor()
+        try:
+            cursor.execute('''
+                INSERT OR REPLACE INTO ModelTuning (model_path, host, n_threads, n_batch, n_ctx,
+                                                    prompt_tokens_per_second, decode_tokens_per_second, tuned_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (model_path, host, tuning["n_threads"], tuning["n_batch"], tuning["n_ctx"],
+                  tuning["prompt_tokens_per_second"], tuning["decode_tokens_per_second"],
+                  datetime.datetime.now().isoformat(timespec="seconds")))
+            conn.commit()
+        except sqlite3.Error as e:
+            print("Error occurred while saving model tuning:", e)
+        finally:
+            self.release(conn)
+
 # Example of using the DatabaseManager class
 if __name__ == "__main__":
     db_manager = DatabaseManager()
@@ -0,0 +1,134 @@
+import hashlib
+import time
+import types
+
+import numpy as np
+
+WORDS = ("the script scene line draft writer character story page voice rewrite dialogue plot tone "
+         "beat act idea note edit word draft reader moment turn").split()
+
+def word_token(word):
+    return int.from_bytes(hashlib.sha1(word).digest()[:2], "little")
+
+# Token ids run to 2**16, 0 to 2 are kept for special tokens
+TOKEN_WORDS = {word_token(word.encode("utf-8")): word for word in WORDS}
+
+class FakeBatchContext:
+    def __init__(self, llm, n_slots, n_batch, n_ctx):
+        # Batched decoding for BatchEngine: one step costs the prompt tokens it carries plus a single
+        # decode, however many sequences it advances
+        self.llm = llm
+        self._n_ctx = n_ctx
+        self.outputs = {}
+
+    def n_ctx(self):
+        return self._n_ctx
+
+    def clear(self):
+        pass
+
+    def remove_sequence(self, seq_id):
+        pass
+
+    def decode(self, entries):
+        prompt_tokens = sum(1 for entry in entries if not entry[3])
+        time.sleep(prompt_tokens * self.llm.prompt_seconds_per_token + self.llm.decode_seconds_per_token)
+        # Logits are looked up by batch index, as with llama_get_logits_ith
+        self.outputs = {index: (seq_id, pos) for index, (_, pos, seq_id, logits) in enumerate(entries) if logits}
+        return 0
+
+    def logits(self, index):
+        # The next word follows from the sequence and position, the reply ends after reply_tokens words
+        seq_id, pos = self.outputs[index]
+        logits = np.zeros(self.llm.n_vocab(), dtype=np.float32)
+        if pos % self.llm.reply_tokens == self.llm.reply_tokens - 1:
+            logits[self.llm.token_eos()] = 100.0
+        else:
+            logits[word_token(WORDS[(seq_id * 7 + pos) % len(WORDS)].encode("utf-8"))] = 100.0
+        return logits
+
+class FakeLlama:
+    def __init__(self, model_path, chat_format=None, n_ctx=2048, load_seconds=0.05, prompt_seconds_per_token=0.0002,
+                 decode_seconds_per_token=0.005, reply_tokens=64, **kwargs):
+        # Stands in for llama_cpp.Llama with fixed costs per token, so benchmarks run without a real model
+        self.model_path = model_path
+        self.chat_format = chat_format
+        self._n_ctx = n_ctx
+        self.prompt_seconds_per_token = prompt_seconds_per_token
+        self.decode_seconds_per_token = decode_seconds_per_token
+        self.reply_tokens = reply_tokens
+        self.cache = None
+        self.draft_model = None
+        # Checked while the prompt is evaluated, like a llama.cpp abort callback
+        self.should_abort = None
+        time.sleep(load_seconds)
+
+    def set_cache(self, cache):
+        self.cache = cache
+
+    def n_ctx(self):
+        return self._n_ctx
+
+    def n_vocab(self):
+        return 1 << 16
+
+    def token_bos(self):
+        return 1
+
+    def token_eos(self):
+        return 2
+
+    def tokenize(self, text, add_bos=True, special=False):
+        # One token per whitespace-separated word keeps counts easy to reason about
+        tokens = [word_token(word) for word in text.split()]
+        return ([self.token_bos()] if add_bos else []) + tokens
+
+    def detokenize(self, tokens, prev_tokens=None):
+        # Only reply words map back to text, prompt words hash to ids that are not kept
+        return "".join(" " + TOKEN_WORDS[token] for token in tokens if token in TOKEN_WORDS).encode("utf-8")
+
+    def format_prompt(self, messages):
+        return types.SimpleNamespace(prompt="\n".join(message["content"] for message in messages), stop=None)
+
+    def batch_context(self, n_slots, n_batch, n_ctx):
+        return FakeBatchContext(self, n_slots, n_batch, n_ctx)
+
+    def embed(self, text):
+        # A unit vector derived from the text, equal texts embed identically
+        digest = hashlib.sha256(text.encode("utf-8")).digest()
+        vector = [byte - 127.5 for byte in digest]
+        norm = sum(value * value for value in vector) ** 0.5
+        return [value / norm for value in vector]
+
+    def reply(self, messages, max_tokens=None):
+        # The reply depends only on the conversation, so every run produces the same text
+        seed = hashlib.sha256("\n".join(message["content"] for message in messages).encode("utf-8")).digest()
+        count = min(max_tokens or self.reply_tokens, self.reply_tokens)
+        return [WORDS[seed[i % len(seed)] * (i + 1) % len(WORDS)] for i in range(count)]
+
+    def create_chat_completion(self, messages, stream=False, max_tokens=None, **kwargs):
+        prompt_tokens = sum(len(self.tokenize(message["content"].encode("utf-8"), add_bos=False)) + 8
+                            for message in messages)
+        words = self.reply(messages, max_tokens)
+        if not stream:
+            self.evaluate_prompt(prompt_tokens)
+            time.sleep(len(words) * self.decode_seconds_per_token)
+            return {
+                "choices": [{"message": {"role": "assistant", "content": " ".join(words)}, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": len(words)},
+            }
+        return self.stream_chunks(prompt_tokens, words)
+
+    def evaluate_prompt(self, prompt_tokens):
+        deadline = time.monotonic() + prompt_tokens * self.prompt_seconds_per_token
+        while time.monotonic() < deadline:
+            if self.should_abort is not None and self.should_abort():
+                raise RuntimeError("Prompt evaluation was aborted")
+            time.sleep(min(0.01, deadline - time.monotonic()))
+
+    def stream_chunks(self, prompt_tokens, words):
+        self.evaluate_prompt(prompt_tokens)
+        for i, word in enumerate(words):
+            time.sleep(self.decode_seconds_per_token)
+            yield {"choices": [{"delta": {"content": word if i == 0 else " " + word}, "finish_reason": None}]}
+        yield {"choices": [{"delta": {}, "finish_reason": "stop"}]}
@@ -0,0 +1,164 @@
+import mmap
+import os
+import struct
+
+GGUF_MAGIC = b"GGUF"
+
+# Scalar metadata value types and their struct formats
+SCALAR_FORMATS = {0: "<B", 1: "<b", 2: "<H", 3: "<h", 4: "<I", 5: "<i", 6: "<f", 7: "<?", 10: "<Q", 11: "<q", 12: "<d"}
+STRING_TYPE = 8
+ARRAY_TYPE = 9
+
+# Arrays longer than this (token lists, merges) are skipped instead of decoded
+MAX_ARRAY_ITEMS = 64
+
+# general.file_type values written by llama.cpp's quantize tool
+FILE_TYPES = {
+    0: "F32", 1: "F16", 2: "Q4_0", 3: "Q4_1", 7: "Q8_0", 8: "Q5_0", 9: "Q5_1", 10: "Q2_K", 11: "Q3_K_S",
+    12: "Q3_K_M", 13: "Q3_K_L", 14: "Q4_K_S", 15: "Q4_K_M", 16: "Q5_K_S", 17: "Q5_K_M", 18: "Q6_K",
+    19: "IQ2_XXS", 20: "IQ2_XS", 21: "Q2_K_S", 22: "IQ3_XS", 23: "IQ3_XXS", 24: "IQ1_S", 25: "IQ4_NL",
+    26: "IQ3_S", 27: "IQ3_M", 28: "IQ2_S", 29: "IQ2_M", 30: "IQ4_XS", 31: "IQ1_M", 32: "BF16",
+}
+
+# ggml tensor types, used when the file does not record general.file_type
+TENSOR_TYPES = {
+    0: "F32", 1: "F16", 2: "Q4_0", 3: "Q4_1", 6: "Q5_0", 7: "Q5_1", 8: "Q8_0", 9: "Q8_1", 10: "Q2_K",
+    11: "Q3_K", 12: "Q4_K", 13: "Q5_K", 14: "Q6_K", 15: "Q8_K", 16: "IQ2_XXS", 17: "IQ2_XS", 18: "IQ3_XXS",
+    19: "IQ1_S", 20: "IQ4_NL", 21: "IQ3_S", 22: "IQ2_S", 23: "IQ4_XS", 24: "I8", 25: "I16", 26: "I32",
+    27: "I64", 28: "F64", 29: "IQ1_M", 30: "BF16",
+}
+
+class GGUFReader:
+    def __init__(self, model_path):
+        # Walks the header of a memory-mapped GGUF file, tensor data is never touched
+        self.model_path = model_path
+        self.buffer = None
+        self.offset = 0
+
+    def read(self, fmt):
+        value = struct.unpack_from(fmt, self.buffer, self.offset)
+        self.offset += struct.calcsize(fmt)
+        return value[0]
+
+    def read_string(self):
+        length = self.read("<Q")
+        value = bytes(self.buffer[self.offset:self.offset + length])
+        self.offset += length
+        return value.decode("utf-8", errors="replace")
+
+    def read_value(self, value_type):
+        if value_type in SCALAR_FORMATS:
+            return self.read(SCALAR_FORMATS[value_type])
+        if value_type == STRING_TYPE:
+            return self.read_string()
+        if value_type == ARRAY_TYPE:
+            item_type = self.read("<I")
+            count = self.read("<Q")
+            if count > MAX_ARRAY_ITEMS:
+                self.skip_array(item_type, count)
+                return None
+            return [self.read_value(item_type) for _ in range(count)]
+        raise ValueError("Unknown GGUF value type {}".format(value_type))
+
+    def skip_array(self, item_type, count):
+        if item_type in SCALAR_FORMATS:
+            self.offset += struct.calcsize(SCALAR_FORMATS[item_type]) * count
+        elif item_type == STRING_TYPE:
+            for _ in range(count):
+                length = self.read("<Q")
+                self.offset += length
+        else:
+            for _ in range(count):
+                self.read_value(item_type)
+
+    def read_header(self):
+        with open(self.model_path, "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as self.buffer:
+                try:
+                    return self.parse()
+                except struct.error:
+                    raise ValueError("{} has a truncated GGUF header".format(self.model_path))
+
+    def parse(self):
+        if self.buffer[:4] != GGUF_MAGIC:
+            raise ValueError("{} is not a GGUF file".format(self.model_path))
+        self.offset = 4
+        version = self.read("<I")
+        # Version 1 used 32-bit counts
+        count_format = "<I" if version == 1 else "<Q"
+        tensor_count = self.read(count_format)
+        kv_count = self.read(count_format)
+
+        metadata = {}
+        for _ in range(kv_count):
+            key = self.read_string()
+            metadata[key] = self.read_value(self.read("<I"))
+
+        parameter_count = 0
+        type_elements = {}
+        for _ in range(tensor_count):
+            self.read_string()
+            n_dims = self.read("<I")
+            elements = 1
+            for _ in range(n_dims):
+                elements *= self.read("<Q")
+            tensor_type = self.read("<I")
+            self.read("<Q")
+            parameter_count += elements
+            type_elements[tensor_type] = type_elements.get(tensor_type, 0) + elements
+        return version, metadata, parameter_count, type_elements
+
+def detect_chat_format(chat_template):
+    # Map the embedded template onto one of llama-cpp-python's named formats where it clearly matches.
+    # None means the template is passed through, Llama then formats prompts with it directly
+    if not chat_template:
+        return "llama-2"
+    if "<|im_start|>" in chat_template:
+        return "chatml"
+    if "[INST]" in chat_template:
+        return "llama-2" if "<<SYS>>" in chat_template else "mistral-instruct"
+    return None
+
+def read_gguf_metadata(model_path):
+    version, metadata, parameter_count, type_elements = GGUFReader(model_path).read_header()
+    architecture = metadata.get("general.architecture")
+    file_type = metadata.get("general.file_type")
+    if file_type in FILE_TYPES:
+        quantization = FILE_TYPES[file_type]
+    elif type_elements:
+        # Without a recorded file type, name the format holding most of the weights
+        quantization = TENSOR_TYPES.get(max(type_elements, key=type_elements.get))
+    else:
+        quantization = None
+    chat_template = metadata.get("tokenizer.chat_template")
+    return {
+        "architecture": architecture,
+        "context_length": metadata.get("{}.context_length".format(architecture)),
+        "quantization": quantization,
+        "parameter_count": parameter_count,
+        "chat_template": chat_template,
+        "chat_format": detect_chat_format(chat_template),
+    }
+
+def resolve_chat_format(model_path, db_manager=None, default="llama-2"):
+    # Use the format cached on the Model row, indexing the file first if it has not been yet
+    metadata = db_manager.get_model_metadata(model_path) if db_manager is not None else None
+    if metadata is None and os.path.isfile(model_path):
+        try:
+            metadata = read_gguf_metadata(model_path)
+        except (OSError, ValueError) as e:
+            print("Error occurred while reading model header:", e)
+        else:
+            if db_manager is not None:
+                db_manager.update_model_metadata(model_path, metadata)
+    if metadata is None:
+        return default
+    # None lets llama.cpp format prompts with the template embedded in the file
+    return metadata["chat_format"]
+
+def describe_parameters(parameter_count):
+    if not parameter_count:
+        return ""
+    if parameter_count >= 1e9:
+        return "{:.1f}B".format(parameter_count / 1e9)
+    return "{:.0f}M".format(parameter_count / 1e6)
@@ -4,9 +4,27 @@ from PyQt5.QtCore import Qt, QObject, pyqtSignal, QThread,QTimer
 from PyQt5.QtGui import QMouseEvent, QFont
 from PyQt5 import QtCore, QtGui, QtWidgets
 from main_ui import Ui_MainWindow
-from chatModel import ChatModel     
+from backends import BACKENDS, DEFAULT_BACKEND, create_chat_model, get_backend
+from modelManager import ModelManager
+from sessionState import SessionStateStore
+from responseCache import ResponseCache
+from cpuTuner import CpuTuner, host_id, tuning_options
+from ggufReader import describe_parameters, read_gguf_metadata, resolve_chat_format
 from database import DatabaseManager
+from modelScanner import ModelDirectoryScanner
+from modelHash import ModelHashIndexer
+from messageWriter import MessageWriter
 import datetime
+import itertools
+import os
+import queue
+import threading
+import time
+
+# Messages loaded per page in the session view, older pages follow on scroll-up
+HISTORY_PAGE = 50
+# Messages handed to the model when a session is resumed, more than a context window holds
+RESUME_MESSAGES = 200
 
   # Import create_database from database.py
 class ModelFrame(QtWidgets.QFrame):
@@ -29,32 +47,256 @@ class ChatWorker(QObject):
         super().__init__()  
         self.model = model
 
-    def process_question(self, question):
-        try:
-            response = self.model.generate_response(question)
-            return response
-        except Exception as e:
-            print("Error:", e)
-            self.finished.emit(str(e))
+    def stream_question(self, question):
+        # Yield the response token by token as the model produces it, errors reach InferenceWorker
+        for token in self.model.generate_response(question, stream=True):
+            yield token
+
+class InferenceJob:
+    def __init__(self, job_id, question, session_id, priority):
+        self.job_id = job_id
+        self.question = question
+        self.session_id = session_id
+        self.priority = priority
+        self.enqueued_at = time.monotonic()
+        self.cancelled = threading.Event()
+
+    def __lt__(self, other):
+        # Lower priority values run first, equal priorities run in submission order
+        return (self.priority, self.job_id) < (other.priority, other.job_id)
+
+class InferenceWorker(QThread):
+    token_signal = pyqtSignal(int, str)
+    finished_signal = pyqtSignal(int, str)
+    cancelled_signal = pyqtSignal(int, str)
+    failed_signal = pyqtSignal(int, str)
+    queue_signal = pyqtSignal(int, float)
+
+    def __init__(self):
+        super().__init__()
+        # One long-lived thread owns the model and answers jobs in priority order
+        self.jobs = queue.PriorityQueue()
+        self.job_ids = itertools.count(1)
+        self.pending = {}
+        self.current_job = None
+        self.worker = None
+        self.condition = threading.Condition()
+        self.running = True
+        # Set when the model failed to load, jobs then fail right away instead of waiting for it
+        self.load_error = None
+        # Models replaced while a job may still use them, closed on this thread
+        self.retired = []
+
+    def set_model(self, model):
+        # Jobs wait in the queue while no model is set
+        with self.condition:
+            self.worker = ChatWorker(model) if model is not None else None
+            self.load_error = None
+            self.condition.notify_all()
+
+    def retire_model(self, model):
+        # Detach the model without touching it on the caller's thread: its current job is cancelled and
+        # it is closed on this thread once nothing generates with it anymore
+        with self.condition:
+            if self.worker is not None and self.worker.model is model:
+                self.worker = None
+                if self.current_job is not None:
+                    self.current_job.cancelled.set()
+            self.retired.append(model)
+            self.condition.notify_all()
+        # Wake the thread up if it is waiting for a job
+        self.jobs.put(InferenceJob(0, None, None, float("-inf")))
+
+    def close_retired(self):
+        with self.condition:
+            models, self.retired = self.retired, []
+        for model in models:
+            if hasattr(model, "close"):
+                model.close()
+
+    def set_load_error(self, error):
+        # Fail the waiting jobs and every new one until another model is set
+        with self.condition:
+            self.worker = None
+            self.load_error = error
+            self.condition.notify_all()
+
+    def submit(self, question, session_id, priority=0):
+        job = InferenceJob(next(self.job_ids), question, session_id, priority)
+        with self.condition:
+            self.pending[job.job_id] = job
+        self.jobs.put(job)
+        return job.job_id
+
+    def cancel(self, job_id):
+        with self.condition:
+            job = self.pending.get(job_id)
+            if job is None and self.current_job is not None and self.current_job.job_id == job_id:
+                job = self.current_job
+            if job is not None:
+                job.cancelled.set()
+            self.condition.notify_all()
+
+    def cancel_all(self):
+        with self.condition:
+            for job in self.pending.values():
+                job.cancelled.set()
+            if self.current_job is not None:
+                self.current_job.cancelled.set()
+            self.condition.notify_all()
+
+    def queue_depth(self):
+        with self.condition:
+            return sum(not job.cancelled.is_set() for job in self.pending.values())
+
+    def stop(self):
+        self.cancel_all()
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        # Wake the thread up if it is waiting for a job
+        self.jobs.put(InferenceJob(0, None, None, float("inf")))
+
+    def run(self):
+        while True:
+            self.close_retired()
+            job = self.jobs.get()
+            if job.question is None and self.running:
+                continue
+            with self.condition:
+                if not self.running:
+                    break
+                self.pending.pop(job.job_id, None)
+                self.current_job = job
+                # Hold the job until a model is available
+                while self.worker is None and self.load_error is None and self.running and not job.cancelled.is_set():
+                    self.condition.wait()
+                if not self.running:
+                    break
+                if job.cancelled.is_set():
+                    self.current_job = None
+                    self.cancelled_signal.emit(job.job_id, "")
+                    continue
+                if self.worker is None:
+                    self.current_job = None
+                    self.failed_signal.emit(job.job_id, self.load_error)
+                    continue
+                worker = self.worker
+
+            wait_time = time.monotonic() - job.enqueued_at
+            self.queue_signal.emit(self.queue_depth(), wait_time)
+            response = ""
+            try:
+                # Tell the model which session it is answering so its state can be saved, Stop aborts it
+                worker.model.session_id = job.session_id
+                worker.model.abort_event = job.cancelled
+                tokens = worker.stream_question(job.question)
+                # Forward every token to the UI as soon as it is generated
+                for token in tokens:
+                    if job.cancelled.is_set():
+                        tokens.close()
+                        break
+                    response += token
+                    self.token_signal.emit(job.job_id, token)
+            except Exception as e:
+                with self.condition:
+                    self.current_job = None
+                if job.cancelled.is_set():
+                    # Stopped while the prompt was evaluated, the engine reports that as an error
+                    self.cancelled_signal.emit(job.job_id, response)
+                    continue
+                print("Error:", e)
+                # Reported to the user, but not saved as the model's answer
+                self.failed_signal.emit(job.job_id, "Error occurred while processing the question.")
+                continue
+            with self.condition:
+                self.current_job = None
+            if job.cancelled.is_set():
+                self.cancelled_signal.emit(job.job_id, response)
+            else:
+                self.finished_signal.emit(job.job_id, response)
+        self.close_retired()
+
+class ModelScanThread(QThread):
+    models_signal = pyqtSignal(list, list)
+
+    def __init__(self, db_name, interval=60):
+        super().__init__()
+        # Own DatabaseManager so the scan never shares state with the UI thread
+        self.scanner = ModelDirectoryScanner(DatabaseManager(db_name))
+        self.interval = interval
+        self.wake_event = threading.Event()
+        self.running = True
 
-class TimerThread(QThread):
-    timeout_signal = pyqtSignal(str)
+    def rescan(self):
+        self.wake_event.set()
 
-    def __init__(self, user_question, worker):
+    def stop(self):
+        self.running = False
+        self.wake_event.set()
+
+    def run(self):
+        while self.running:
+            try:
+                # Every committed batch is sent on so the model page fills in while the scan runs
+                self.scanner.scan(on_batch=lambda rows, removed: self.models_signal.emit(rows, removed))
+            except Exception as e:
+                print("Error occurred while scanning model directories:", e)
+            self.wake_event.wait(self.interval)
+            self.wake_event.clear()
+        self.scanner.db_manager.close()
+
+class ModelLoaderThread(QThread):
+    progress_signal = pyqtSignal(int, str)
+    ready_signal = pyqtSignal(object)
+    failed_signal = pyqtSignal(str, str)
+
+    def __init__(self, model_path, chat_format, backend, model_options, db_manager=None, auto_tune=False):
         super().__init__()
-        self.user_question = user_question
-        self.worker = worker
+        self.model_path = model_path
+        self.chat_format = chat_format
+        # Registered backend that builds the chat model, see backends.py
+        self.backend = backend
+        # Keyword arguments passed on to ChatModel (model manager, caches, sampling)
+        self.model_options = model_options
+        # Saved CPU tuning for this model and host is applied, or measured first when auto_tune is set
+        self.db_manager = db_manager
+        self.auto_tune = auto_tune
+
+    def apply_tuning(self):
+        tuning = self.db_manager.get_model_tuning(self.model_path, host_id())
+        if tuning is None and self.auto_tune:
+            tuner = CpuTuner(self.model_path, self.db_manager)
+            tuning = tuner.run(progress=lambda percent: self.progress_signal.emit(min(percent, 99), "Tuning for this CPU..."))
+        if tuning is None:
+            return
+        # Settings given explicitly win over the tuned ones
+        self.model_options["llama_options"] = dict(tuning_options(tuning), **(self.model_options.get("llama_options") or {}))
 
     def run(self):
+        # Build the ChatModel off the UI thread so the window stays responsive
+        self.progress_signal.emit(0, "Loading model...")
         try:
-            response = self.worker.process_question(self.user_question)
-            self.timeout_signal.emit(response)
+            if self.db_manager is not None and get_backend(self.backend).tunable:
+                self.apply_tuning()
+                self.progress_signal.emit(0, "Loading model...")
+            model = create_chat_model(self.backend, self.model_path, self.chat_format, **self.model_options)
         except Exception as e:
             print("Error:", e)
-            self.timeout_signal.emit("Error occurred while processing the question.")
+            self.failed_signal.emit(self.model_path, str(e))
+            return
+        finally:
+            # The thread ends here, close the connection the tuning lookup opened
+            if self.db_manager is not None:
+                self.db_manager.close_thread_connection()
+        self.progress_signal.emit(100, "Model ready")
+        self.ready_signal.emit(model)
 
 
 class MainWindow(QMainWindow, Ui_MainWindow):
+    # Emitted from the hashing threads, the model page is refreshed on the UI thread
+    duplicate_signal = pyqtSignal(str, str)
+
     def __init__(self):
         super(MainWindow, self).__init__()
 
@@ -67,9 +309,52 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         self.model_path = None  # Initialize model path
         self.active_model_name = None  # Initialize active model
         self.active_model_path=None
+        self.model = None
+        # Session of every question waiting for or receiving an answer
+        self.job_sessions = {}
+        # One persistent thread answers questions in order and can be stopped
+        self.inference_worker = InferenceWorker()
+        self.inference_worker.token_signal.connect(self.on_token_received)
+        self.inference_worker.finished_signal.connect(self.on_job_finished)
+        self.inference_worker.cancelled_signal.connect(self.on_job_cancelled)
+        self.inference_worker.failed_signal.connect(self.on_job_failed)
+        self.inference_worker.queue_signal.connect(self.on_queue_stats)
+        self.inference_worker.start()
+        # Conversation carried over when switching models mid-chat
+        self.previous_messages = []
+        # Keep loader threads alive until they finish
+        self.loader_threads = []
+        # Only the most recently started load may set the model, earlier ones are stale even for the same path
+        self.current_loader = None
         # Call the function to create the database and table
         self.db_manager = DatabaseManager()
         self.db_manager.create_database()
+        # Messages are committed in the background, reads of the history flush it first
+        self.message_writer = MessageWriter(DatabaseManager(self.db_manager.db_name))
+        # Keep recently used models resident so switching back is instant
+        max_memory_mb = int(os.environ.get("SCRIPTSAGE_MODEL_MEMORY_MB", 8192))
+        self.model_manager = ModelManager(max_memory=max_memory_mb * 1024 * 1024)
+        # Saved llama states per chat session for instant resume
+        self.state_store = SessionStateStore()
+        # Answers to repeated questions, only used when sampling is deterministic
+        self.response_cache = ResponseCache(self.db_manager)
+        self.sampling_params = {}
+        if "SCRIPTSAGE_TEMPERATURE" in os.environ:
+            self.sampling_params["temperature"] = float(os.environ["SCRIPTSAGE_TEMPERATURE"])
+        if "SCRIPTSAGE_SEED" in os.environ:
+            self.sampling_params["seed"] = int(os.environ["SCRIPTSAGE_SEED"])
+        # Similarity above which a paraphrased question is answered from the semantic cache
+        self.semantic_threshold = None
+        if "SCRIPTSAGE_SEMANTIC_THRESHOLD" in os.environ:
+            self.semantic_threshold = float(os.environ["SCRIPTSAGE_SEMANTIC_THRESHOLD"])
+        # Speculative decoding: "lookup" drafts from the prompt, a GGUF path uses that file as draft model
+        self.speculative = os.environ.get("SCRIPTSAGE_SPECULATIVE") or None
+        # Measure the fastest thread, batch and context settings the first time a model loads on this machine
+        self.auto_tune = os.environ.get("SCRIPTSAGE_AUTO_TUNE") == "1"
+        # Run llama.cpp in a child process so a native crash cannot take the window down
+        self.out_of_process = os.environ.get("SCRIPTSAGE_OUT_OF_PROCESS") == "1"
+        # Session being continued from the history page, None means today's session
+        self.current_session_id = None
         self.resize(550, 800)  # Set the window size to 800x600 pixels
         # Add frames for all models
         self.add_model_frames()
@@ -82,11 +367,30 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         self.initialize_chat()
         # Connect the btnAddModel button to open file dialog
         self.btnAddModel.clicked.connect(self.open_file_dialog)
+        # Watched folders are scanned in the background, the model page updates as files come and go
+        self.btnAddFolder = QtWidgets.QPushButton("Add Folder", self.modelScrollAreaFrame)
+        self.btnAddFolder.setCursor(QtGui.QCursor(QtCore.Qt.PointingHandCursor))
+        self.btnAddFolder.setStyleSheet(self.btnAddModel.styleSheet())
+        self.verticalLayout_41.addWidget(self.btnAddFolder)
+        self.btnAddFolder.clicked.connect(self.open_folder_dialog)
+        for directory in filter(None, os.environ.get("SCRIPTSAGE_MODEL_DIRS", "").split(os.pathsep)):
+            self.db_manager.add_watched_directory(os.path.abspath(directory).replace(os.sep, "/"))
+        self.scan_thread = ModelScanThread(self.db_manager.db_name, int(os.environ.get("SCRIPTSAGE_SCAN_INTERVAL", 60)))
+        self.scan_thread.models_signal.connect(self.on_models_scanned)
+        self.scan_thread.start()
+        # Full content hashes identify models across renames and copies, read slowly so chatting is not disturbed
+        self.duplicate_signal.connect(self.on_duplicate_found)
+        self.hash_indexer = ModelHashIndexer(DatabaseManager(self.db_manager.db_name),
+                                             max_bytes_per_second=int(os.environ.get("SCRIPTSAGE_HASH_MB_PER_SECOND", 256)) * 1024 * 1024,
+                                             on_duplicate=self.duplicate_signal.emit)
+        self.hash_indexer.submit_unhashed()
         # Set a flag to track if the thread has been started
         self.thread_started = False
         self.flag=False
         # Initialize loading_frame to None
         self.loading_frame = None
+        # Label of the AI message currently being streamed
+        self.streaming_label = None
 
         # Connect the btnBrowse button to open file dialog
         self.btnClose.clicked.connect(self.close)
@@ -96,20 +400,122 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         self.btnPlugins.clicked.connect(self.btnPluginsClicked)
         self.btnNext.clicked.connect(self.btnNextClicked)
 
+        # Session view paging: the open session, the first message id shown and whether older ones exist
+        self.history_session_id = None
+        self.history_oldest_id = None
+        self.history_has_more = False
+        # Distance from the bottom to keep once the layout has grown, set while a page is being added
+        self.history_scroll_anchor = None
+        history_scroll_bar = self.specifcHistoryScroll.verticalScrollBar()
+        history_scroll_bar.valueChanged.connect(self.on_history_scrolled)
+        history_scroll_bar.rangeChanged.connect(self.on_history_range_changed)
+        # Viewing a past session leaves the chat alone, this button makes the chat page continue it
+        self.btnContinueSession = QtWidgets.QPushButton("Continue this session", self.SpecificHistoryPage)
+        self.btnContinueSession.setCursor(QtGui.QCursor(QtCore.Qt.PointingHandCursor))
+        self.btnContinueSession.setStyleSheet(self.btnAddModel.styleSheet())
+        self.verticalLayout_3.insertWidget(0, self.btnContinueSession)
+        self.btnContinueSession.clicked.connect(self.continue_history_session)
+
         # Connect the sendMessage button to send the message for processing
         self.btnSendMessage.clicked.connect(self.send_message)
 
+        # Stop button cancels the running answer and anything still queued
+        self.btnStop = QtWidgets.QPushButton("Stop", self.chatArea)
+        self.btnStop.setMinimumSize(QtCore.QSize(45, 32))
+        self.btnStop.setMaximumSize(QtCore.QSize(45, 32))
+        self.btnStop.setCursor(QtGui.QCursor(QtCore.Qt.PointingHandCursor))
+        self.btnStop.setStyleSheet("background:#F5F5F5;\n"
+"border:2px solid #606268;\n"
+"font: bold 8pt \"Roboto\";\n"
+"color:#606268;\n"
+"border-left:none;")
+        self.btnStop.setFlat(True)
+        self.btnStop.hide()
+        self.horizontalLayout_4.addWidget(self.btnStop)
+        self.btnStop.clicked.connect(self.stop_generation)
+
     def initialize_chat(self):
         # Check if active model path exists
         if self.active_model_path:
-            # Initialize ChatModel and ChatWorker with active model path
-            self.model = ChatModel(model_path=self.active_model_path, chat_format="llama-2")
-            self.worker = ChatWorker(self.model)
+            # Load the ChatModel in the background, ChatWorker is created once it is ready
+            if self.model is not None:
+                self.previous_messages = self.model.messages
+                # The inference thread may still be answering with it, so it is closed there
+                self.inference_worker.retire_model(self.model)
+            self.model = None
+            self.inference_worker.set_model(None)
             self.active_model_name = self.get_active_model_name_without_extension()
-            self.btnModel.setText(self.active_model_name)
+            backend = self.db_manager.get_model_backend(self.active_model_path) or DEFAULT_BACKEND
+            if self.out_of_process and backend == DEFAULT_BACKEND:
+                backend = "subprocess"
+            loader_thread = ModelLoaderThread(self.active_model_path, resolve_chat_format(self.active_model_path, self.db_manager), backend,
+                                              self.get_model_options(),
+                                              self.db_manager, self.auto_tune)
+            loader_thread.progress_signal.connect(self.on_model_load_progress)
+            loader_thread.ready_signal.connect(self.on_model_ready)
+            loader_thread.failed_signal.connect(self.on_model_load_failed)
+            loader_thread.finished.connect(lambda thread=loader_thread: self.loader_threads.remove(thread))
+            self.loader_threads.append(loader_thread)
+            self.current_loader = loader_thread
+            loader_thread.start()
 
         else:
             print("No active model found!")
+
+    def read_model_metadata(self, model_path):
+        # Only the GGUF header is read, so this is fast even for very large files
+        try:
+            return read_gguf_metadata(model_path)
+        except (OSError, ValueError) as e:
+            print("Error occurred while reading model header:", e)
+            return None
+
+    def get_model_options(self):
+        return {
+            "model_manager": self.model_manager,
+            "state_store": self.state_store,
+            "sampling_params": self.sampling_params,
+            "response_cache": self.response_cache,
+            "semantic_threshold": self.semantic_threshold,
+            # The model's own setting, SCRIPTSAGE_SPECULATIVE applies to models without one
+            "speculative": self.db_manager.get_model_speculative(self.active_model_path) or self.speculative,
+            # Content hash from the index, ChatModel fingerprints the file while it is still being hashed
+            "model_hash": self.db_manager.get_model_hash(self.active_model_path),
+        }
+
+    def on_model_load_progress(self, percent, message):
+        if self.sender() is not self.current_loader:
+            return
+        if percent < 100:
+            self.btnModel.setText("{} ({}%)".format(message, percent))
+
+    def on_model_ready(self, model):
+        # Ignore models from loads started before the latest one, for another model or another backend
+        if self.sender() is not self.current_loader:
+            if hasattr(model, "close"):
+                model.close()
+            return
+        self.current_loader = None
+        if self.model is not None and self.model is not model:
+            self.inference_worker.retire_model(self.model)
+        self.model = model
+        # Continue the conversation that is on screen with the new model
+        if self.current_session_id is not None:
+            self.model.resume_session(self.current_session_id, self.previous_messages)
+        else:
+            self.model.reset_conversation(self.previous_messages)
+        self.btnModel.setText(self.active_model_name)
+        # Queued questions are answered as soon as the worker has a model
+        self.inference_worker.set_model(self.model)
+
+    def on_model_load_failed(self, model_path, error):
+        if self.sender() is not self.current_loader:
+            return
+        self.current_loader = None
+        self.btnModel.setText("Model failed to load")
+        # Queued and new questions are answered with the error, not saved, until a model loads
+        self.inference_worker.set_load_error("Error occurred while loading the model: " + error)
+
     def add_chat_frames(self):
         # Remove any existing model frames
         # for i in reversed(range(self.verticalLayout_42.count())):
@@ -119,6 +525,7 @@ class MainWindow(QMainWindow, Ui_MainWindow):
             if widget is not None:
                 widget.deleteLater()
        
+        self.message_writer.flush()
         chat_history = self.db_manager.fetch_chat_history()
         for chat in chat_history:
             frame = self.create_chat_history_frame(chat)
@@ -134,11 +541,49 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         models = self.db_manager.fetch_all_models()
 
         # Add frames for each model
+        self.model_frames = {}
         for model in models:
-            frame = self.create_model_frame(model)
-            # Connect the model frame's clicked signal to a custom slot
-            frame.modelFrameClicked.connect(self.handle_model_frame_clicked)
-            self.verticalLayout_42.addWidget(frame)
+            self.add_model_frame(model)
+
+    def add_model_frame(self, model, index=-1):
+        frame = self.create_model_frame(model)
+        # Connect the model frame's clicked signal to a custom slot
+        frame.modelFrameClicked.connect(self.handle_model_frame_clicked)
+        self.verticalLayout_42.insertWidget(index, frame)
+        self.model_frames[model[2]] = frame
+
+    def on_models_scanned(self, rows, removed):
+        # Only the frames of models that changed are touched
+        for path in removed:
+            frame = self.model_frames.pop(path, None)
+            if frame is not None:
+                frame.setParent(None)
+                frame.deleteLater()
+        for model in rows:
+            self.replace_model_frame(model)
+            self.hash_indexer.submit(model[2])
+
+    def replace_model_frame(self, model):
+        # Rebuild one model's frame in place, or append it if it is new
+        old_frame = self.model_frames.get(model[2])
+        index = self.verticalLayout_42.indexOf(old_frame) if old_frame is not None else -1
+        if old_frame is not None:
+            old_frame.setParent(None)
+            old_frame.deleteLater()
+        self.add_model_frame(model, index)
+
+    def on_duplicate_found(self, model_path, duplicate_of):
+        print("{} has the same content as {}".format(model_path, duplicate_of))
+        # Only the duplicate's frame changes
+        model = self.db_manager.fetch_model(model_path)
+        if model is not None and model_path in self.model_frames:
+            self.replace_model_frame(model)
+
+    def open_folder_dialog(self):
+        directory = QFileDialog.getExistingDirectory(self, "Select Model Folder", "", QFileDialog.DontUseNativeDialog)
+        if directory:
+            self.db_manager.add_watched_directory(directory)
+            self.scan_thread.rescan()
 
     def get_active_model_name_without_extension(self):
         active_model_name = self.db_manager.get_active_model_name()  
@@ -152,12 +597,78 @@ class MainWindow(QMainWindow, Ui_MainWindow):
             widget = self.specificHistoryFrame.layout().itemAt(i).widget()
             if widget is not None:
                 widget.deleteLater()
-        messages = self.db_manager.fetch_messages_by_session_id(int(id))
-        
-        for message in messages:
-            frame=self.create_chat_message_frame(message[0],message[1])
-            self.specificHistoryFrame.layout().addWidget(frame)
-            self.stackedWidget.setCurrentIndex(6)
+        self.message_writer.flush()
+        # Only the newest page is built, older messages are loaded when the user scrolls up
+        self.history_session_id = int(id)
+        self.history_oldest_id = None
+        self.history_has_more = True
+        self.load_history_page()
+        self.stackedWidget.setCurrentIndex(6)
+
+    def continue_history_session(self):
+        # Make the viewed session the one the chat page continues, today's session is continued the same way
+        if self.history_session_id is None:
+            return
+        self.resume_session(self.history_session_id,
+                            self.db_manager.fetch_messages_page(self.history_session_id, limit=RESUME_MESSAGES))
+        # Switch to the chat page like btnNextClicked, setBold would otherwise style the Continue button
+        self.setBold("Next")
+        self.stackedWidget.setCurrentIndex(1)
+
+    def load_history_page(self):
+        messages = self.db_manager.fetch_messages_page(self.history_session_id, self.history_oldest_id, HISTORY_PAGE)
+        self.history_has_more = len(messages) == HISTORY_PAGE
+        if not messages:
+            return
+        first_page = self.history_oldest_id is None
+        self.history_oldest_id = messages[0][0]
+        # Keep the view where it was relative to the bottom, the first page starts at the bottom
+        scroll_bar = self.specifcHistoryScroll.verticalScrollBar()
+        self.history_scroll_anchor = 0 if first_page else scroll_bar.maximum() - scroll_bar.value()
+        for index, (_, sender, text, _) in enumerate(messages):
+            frame = self.create_chat_message_frame(sender, text)
+            self.specificHistoryFrame.layout().insertWidget(index, frame)
+
+    def on_history_scrolled(self, value):
+        scroll_bar = self.specifcHistoryScroll.verticalScrollBar()
+        if value == scroll_bar.minimum() and self.history_has_more:
+            self.load_history_page()
+
+    def on_history_range_changed(self, minimum, maximum):
+        if self.history_scroll_anchor is not None:
+            self.specifcHistoryScroll.verticalScrollBar().setValue(maximum - self.history_scroll_anchor)
+            self.history_scroll_anchor = None
+
+    def resume_session(self, session_id, messages):
+        # messages are (message_id, sender, message_text, timestamp) rows, oldest first
+        self.current_session_id = session_id
+        conversation = [
+            {"role": "user" if sender == "You" else "assistant", "content": text}
+            for _, sender, text, _ in messages
+        ]
+        self.previous_messages = conversation
+        if self.model is not None:
+            # The saved llama state is restored before the next answer instead of re-evaluating the transcript
+            self.model.resume_session(session_id, conversation)
+
+        # Show the resumed conversation on the chat page
+        for i in reversed(range(self.chatFrame.layout().count())):
+            widget = self.chatFrame.layout().itemAt(i).widget()
+            if widget is not None:
+                widget.deleteLater()
+        self.loading_frame = None
+        self.streaming_label = None
+        # The chat page shows the latest exchange, the full transcript is on the history page
+        for _, sender, text, _ in messages[-HISTORY_PAGE:]:
+            self.create_message_frame(sender, text)
+        if self.flag==False:
+            self.lblQuery.deleteLater() 
+            self.flag=True
+
+    def get_current_session_id(self):
+        if self.current_session_id is not None:
+            return self.current_session_id
+        return self.db_manager.get_or_create_session_id()
 
 
     def handle_model_frame_clicked(self, title, path):
@@ -172,7 +683,23 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         self.initialize_chat()
         # Update the model frames to reflect the changes
         self.add_model_frames()
+    def change_model_backend(self, model_name, path, backend):
+        self.db_manager.set_model_backend(model_name, backend)
+        if path == self.active_model_path:
+            # Reload the active model with its new backend
+            self.initialize_chat()
+
+    def change_model_speculative(self, model_name, path, speculative):
+        self.db_manager.set_model_speculative(model_name, speculative)
+        if path == self.active_model_path:
+            # Reload the active model with its drafter attached or removed
+            self.initialize_chat()
+
     def remove_model(self, model_name):
+        # Release the model from memory before removing it from the database
+        for model in self.db_manager.fetch_all_models() or []:
+            if model[1] == model_name:
+                self.model_manager.unload(model[2])
         # Remove the model from the database
         self.db_manager.remove_model(model_name)
         # Check if any model is active after removal
@@ -230,6 +757,11 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         # Add the message frame to the vertical layout
         layout.addWidget(message_frame)
 
+        # Message count and estimated tokens from the session summary (model[3] and model[5])
+        lbl_details = QtWidgets.QLabel("{} messages · ~{} tokens".format(model[3], model[5]))
+        lbl_details.setStyleSheet("background-color: white;font: 8pt \"Roboto\"; color:#606268;")
+        layout.addWidget(lbl_details)
+
         return frame
 
     
@@ -284,6 +816,28 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         # Connect the clicked signal of the remove button to the remove_model function
         btn_remove.clicked.connect(lambda _, model_name=model[1]: self.remove_model(model_name))
 
+        # Backend that runs this model, out-of-process execution is a global setting so it is not offered here
+        cmb_backend = QtWidgets.QComboBox()
+        cmb_backend.addItems(sorted(name for name, backend in BACKENDS.items() if hasattr(backend, "create_engine")))
+        cmb_backend.setCurrentText(model["backend"] or DEFAULT_BACKEND)
+        cmb_backend.setStyleSheet("color:#606268; font: 8pt \"Roboto\";")
+        cmb_backend.currentTextChanged.connect(
+            lambda backend, model_name=model[1], path=model[2]: self.change_model_backend(model_name, path, backend))
+        name_layout.addWidget(cmb_backend, 0, QtCore.Qt.AlignRight)
+
+        # Speculative decoding for this model, a draft GGUF path set elsewhere is shown as it is
+        cmb_speculative = QtWidgets.QComboBox()
+        cmb_speculative.addItem("No speculation", None)
+        cmb_speculative.addItem("Prompt lookup", "lookup")
+        if model["speculative"] not in (None, "lookup"):
+            cmb_speculative.addItem(os.path.basename(model["speculative"]), model["speculative"])
+        cmb_speculative.setCurrentIndex(cmb_speculative.findData(model["speculative"]) if model["speculative"] else 0)
+        cmb_speculative.setStyleSheet("color:#606268; font: 8pt \"Roboto\";")
+        cmb_speculative.currentIndexChanged.connect(
+            lambda index, combo=cmb_speculative, model_name=model[1], path=model[2]:
+                self.change_model_speculative(model_name, path, combo.itemData(index)))
+        name_layout.addWidget(cmb_speculative, 0, QtCore.Qt.AlignRight)
+
         # Add the name frame to the vertical layout
         layout.addWidget(name_frame)
 
@@ -293,6 +847,21 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         lbl_model_path.setWordWrap(True)  # Enable word wrap for the title
         layout.addWidget(lbl_model_path)
 
+        # Architecture, quantization, size and context read from the GGUF header
+        details = [model["architecture"], model["quantization"], describe_parameters(model["parameter_count"]),
+                   "{} ctx".format(model["context_length"]) if model["context_length"] else None]
+        details = [detail for detail in details if detail]
+        if details:
+            lbl_model_details = QtWidgets.QLabel(" · ".join(details))
+            lbl_model_details.setStyleSheet("background-color: white;font: 8pt \"Roboto\"; color:#606268;")
+            layout.addWidget(lbl_model_details)
+
+        # Set by the content hash indexer when another model has the same file contents
+        if model["duplicate_of"]:
+            lbl_duplicate = QtWidgets.QLabel("Duplicate of " + model["duplicate_of"])
+            lbl_duplicate.setStyleSheet("background-color: white;font: 8pt \"Roboto\"; color:#606268;")
+            layout.addWidget(lbl_duplicate)
+
         return frame
 
 
@@ -318,9 +887,10 @@ class MainWindow(QMainWindow, Ui_MainWindow):
             file_path = file_name
             file_name = file_name.split('/')[-1]  # Get just the file name
 
-            # Insert the file name and path into the Model table
-            self.db_manager.insert_model_into_database(file_name, file_path)
+            # Insert the file name, path and header details into the Model table
+            self.db_manager.insert_model_into_database(file_name, file_path, metadata=self.read_model_metadata(file_path))
             self.add_model_frames()
+            self.hash_indexer.submit(file_path)
 
 
     def send_message(self):
@@ -333,11 +903,11 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         if self.active_model_path is None:
             self.show_no_active_model_message()
             return
-        session_id = self.db_manager.get_or_create_session_id()
+        session_id = self.get_current_session_id()
         timestamp = datetime.datetime.now()
         
         # Assuming session_id, sender, message_text, and timestamp are available
-        self.db_manager.save_message(session_id, "You", user_question, timestamp)
+        self.message_writer.save_message(session_id, "You", user_question, timestamp)
         self.create_message_frame("You", user_question,True)
         self.chatScroll.updateGeometry()
         self.chatScroll.verticalScrollBar().setValue(self.chatScroll.verticalScrollBar().maximum())  # Scroll to the bottom
@@ -350,36 +920,100 @@ class MainWindow(QMainWindow, Ui_MainWindow):
             self.flag=True
 
 
-        # Create a timer thread
-        self.timer_thread = TimerThread(user_question, self.worker)
-        self.timer_thread.timeout_signal.connect(self.on_timer_timeout)
-
-        # Start the timer thread
-        self.timer_thread.start()
+        # Queue the question, it waits there until the model is ready
+        job_id = self.inference_worker.submit(user_question, session_id)
+        self.job_sessions[job_id] = session_id
+        self.btnStop.show()
+
+    def stop_generation(self):
+        self.inference_worker.cancel_all()
+
+    def on_queue_stats(self, depth, wait_time):
+        tooltip = "{} question(s) waiting, the current one waited {:.1f}s".format(depth, wait_time)
+        # Cache hit rates so far, as counted by the model answering the questions
+        caches = (self.model.cache_stats() if hasattr(self.model, "cache_stats") else None) or {}
+        for name, stats in caches.items():
+            if stats:
+                tooltip += "\n{}: {} hits, {} misses ({:.0%})".format(
+                    name.replace("_", " ").capitalize(), stats["hits"], stats["misses"], stats["hit_rate"])
+        self.btnStop.setToolTip(tooltip)
+
+    def on_job_finished(self, job_id, response):
+        session_id = self.job_sessions.pop(job_id, None)
+        self.on_response_received(response, session_id)
+
+    def on_job_cancelled(self, job_id, response):
+        session_id = self.job_sessions.pop(job_id, None)
+        if response.strip():
+            # Keep whatever was generated before the stop
+            self.on_response_received(response, session_id)
+        else:
+            if self.loading_frame:
+                self.loading_frame.setParent(None)
+                self.loading_frame = None
+            self.txtChat.setReadOnly(False)
+        if not self.job_sessions:
+            self.btnStop.hide()
+
+    def on_job_failed(self, job_id, error):
+        self.job_sessions.pop(job_id, None)
+        self.show_error_response(error)
+
+    def show_error_response(self, error):
+        # Errors are shown in the chat but never saved to the session
+        if self.loading_frame:
+            self.loading_frame.setParent(None)
+            self.loading_frame = None
+        if self.streaming_label is not None:
+            self.streaming_label.setText(self.streaming_label.text() + "\n\n" + error)
+            self.streaming_label = None
+        else:
+            self.create_message_frame("AI", error)
+        self.txtChat.setReadOnly(False)
+        self.chatScroll.verticalScrollBar().setValue(self.chatScroll.verticalScrollBar().maximum())
+        if not self.job_sessions:
+            self.btnStop.hide()
+
+    def on_token_received(self, job_id, token):
+        if self.streaming_label is None:
+            # First token: swap the loading animation for an AI message frame
+            if self.loading_frame:
+                self.loading_frame.setParent(None)
+                self.loading_frame = None
+            self.streaming_label = self.create_message_frame("AI", token.lstrip())
+        else:
+            self.streaming_label.setText(self.streaming_label.text() + token)
+        self.chatScroll.verticalScrollBar().setValue(self.chatScroll.verticalScrollBar().maximum())  # Keep the newest tokens in view
 
-    def on_timer_timeout(self, response):
-        # Pass the response to on_response_received method
-        self.on_response_received(response)
-    def on_response_received(self, response):
+    def on_response_received(self, response, session_id=None):
         # Remove leading and trailing spaces from the response
         response = response.strip()
 
         # Display the response in the chat window
-        session_id = self.db_manager.get_or_create_session_id()
+        if session_id is None:
+            session_id = self.get_current_session_id()
         timestamp = datetime.datetime.now()
         
         # Assuming session_id, sender, message_text, and timestamp are available
-        self.db_manager.save_message(session_id, "AI", response, timestamp)
-        self.create_message_frame("AI", response)
+        self.message_writer.save_message(session_id, "AI", response, timestamp)
+        if self.streaming_label is not None:
+            # The message was already rendered token by token, just tidy it up
+            self.streaming_label.setText(response)
+            self.streaming_label = None
+        else:
+            self.create_message_frame("AI", response)
 
         # Remove the loading frame if it exists
         if self.loading_frame:
             self.loading_frame.setParent(None)
+            self.loading_frame = None
 
         self.txtChat.setReadOnly(False)
         self.chatScroll.updateGeometry()
         self.chatScroll.verticalScrollBar().setValue(self.chatScroll.verticalScrollBar().maximum())  # Scroll to the bottom
         print(self.chatScroll.verticalScrollBar().maximum())  # Print the maximum scroll position
+        if not self.job_sessions:
+            self.btnStop.hide()
        
     def show_blank_question_message(self):
         msg_box = QMessageBox()
@@ -477,13 +1111,34 @@ class MainWindow(QMainWindow, Ui_MainWindow):
             self.loading_frame=loading_frame
 
 
-        return None
+        # Return the message label so streamed tokens can be appended to it
+        return lbl_message
 
 
 
 
         
 
+    def closeEvent(self, event):
+        # Stop the inference and scanner threads before the window goes away
+        # Stopping aborts the current generation, but a native call may still take a moment to return
+        self.inference_worker.stop()
+        stopped = self.inference_worker.wait(5000)
+        self.scan_thread.stop()
+        self.scan_thread.wait()
+        # Hashing stops at the next read, finished chunks are kept and resumed on the next start
+        self.hash_indexer.stop()
+        if not stopped:
+            print("Inference is still running, exiting without closing the model")
+        elif hasattr(self.model, "close"):
+            self.model.close()
+        # Messages still queued are committed before the app exits
+        self.message_writer.close()
+        # A running inference thread may still be using its connection, the process exit releases it
+        if stopped:
+            self.db_manager.close()
+        event.accept()
+
     # Define the mousePressEvent method to handle mouse button press events
     def mousePressEvent(self, event: QMouseEvent) -> None:
         if event.button() == Qt.LeftButton:
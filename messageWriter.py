@@ -0,0 +1,69 @@
+import queue
+import threading
+import time
+
+class MessageWriter:
+    def __init__(self, db_manager, max_batch=64, max_delay=0.05):
+        # Chat messages are written behind the caller's back on one thread, grouped into a transaction
+        # per batch, so saving a message never waits on the disk. The writer closes db_manager when it stops,
+        # so give it its own
+        self.db_manager = db_manager
+        self.max_batch = max_batch
+        # Longest time a message waits for others to share its commit
+        self.max_delay = max_delay
+        self.queue = queue.Queue()
+        self.closed = False
+        self.thread = threading.Thread(target=self.run, name="message-writer", daemon=True)
+        self.thread.start()
+
+    def save_message(self, session_id, sender, message_text, timestamp):
+        if self.closed:
+            # Late writes after close still reach the database, just synchronously
+            self.db_manager.save_messages([(session_id, sender, message_text, timestamp)])
+            return
+        self.queue.put((session_id, sender, message_text, timestamp))
+
+    def flush(self, durable=False, timeout=None):
+        # Wait until everything queued so far is committed, durable also forces it out of the WAL onto disk.
+        # Returns False if the writer did not get there within timeout
+        if self.closed:
+            return True
+        barrier = (threading.Event(), durable)
+        self.queue.put(barrier)
+        return barrier[0].wait(timeout)
+
+    def close(self):
+        # Commit whatever is still queued and stop the thread
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.put(None)
+        self.thread.join()
+
+    def run(self):
+        stopping = False
+        while not stopping:
+            item = self.queue.get()
+            messages, barriers = [], []
+            deadline = time.monotonic() + self.max_delay
+            while True:
+                if item is None:
+                    stopping = True
+                elif isinstance(item[0], threading.Event):
+                    barriers.append(item)
+                else:
+                    messages.append(item)
+                # A barrier or a full batch is committed right away, otherwise wait briefly for more messages
+                if stopping or barriers or len(messages) >= self.max_batch:
+                    break
+                try:
+                    item = self.queue.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+            if messages:
+                self.db_manager.save_messages(messages)
+            if any(durable for _, durable in barriers):
+                self.db_manager.checkpoint()
+            for event, _ in barriers:
+                event.set()
+        self.db_manager.close()
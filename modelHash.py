@@ -0,0 +1,119 @@
+import hashlib
+import mmap
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+FINGERPRINT_CHUNK = 1024 * 1024
+
+def model_fingerprint(model_path):
+    # Cheap identity for a model file: its size plus the first and last megabyte
+    if "://" in model_path:
+        # Models served over HTTP are identified by their URL
+        return hashlib.sha1(model_path.encode("utf-8")).hexdigest()
+    size = os.path.getsize(model_path)
+    digest = hashlib.sha1(str(size).encode("utf-8"))
+    with open(model_path, "rb") as f:
+        digest.update(f.read(FINGERPRINT_CHUNK))
+        if size > FINGERPRINT_CHUNK:
+            f.seek(max(size - FINGERPRINT_CHUNK, FINGERPRINT_CHUNK))
+            digest.update(f.read(FINGERPRINT_CHUNK))
+    return digest.hexdigest()
+
+# Files are hashed in chunks whose digests are combined at the end, so an interrupted hash resumes at a chunk boundary
+HASH_CHUNK = 64 * 1024 * 1024
+READ_SIZE = 8 * 1024 * 1024
+
+def combine_chunk_digests(chunk_digests):
+    return hashlib.sha256(bytes.fromhex("".join(chunk_digests))).hexdigest()
+
+class ModelHashIndexer:
+    def __init__(self, db_manager, workers=2, max_bytes_per_second=256 * 1024 * 1024, chunk_size=HASH_CHUNK,
+                 on_duplicate=None):
+        # Content hashes of model files, computed in a background pool and stored on the Model rows.
+        # on_duplicate(model_path, duplicate_of) is called from a pool thread when a file matches another model
+        self.db_manager = db_manager
+        self.on_duplicate = on_duplicate
+        self.chunk_size = chunk_size
+        self.max_bytes_per_second = max_bytes_per_second
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="model-hash")
+        self.pending = set()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        # Time before which the shared read budget is used up, all workers together stay under the rate
+        self.budget_time = time.monotonic()
+
+    def submit(self, model_path):
+        if "://" in model_path:
+            return
+        with self.lock:
+            if self.stopped.is_set() or model_path in self.pending:
+                return
+            self.pending.add(model_path)
+        self.executor.submit(self.run, model_path)
+
+    def submit_unhashed(self):
+        for model_path in self.db_manager.fetch_unhashed_models():
+            self.submit(model_path)
+
+    def stop(self):
+        # Workers finish their current read and keep the progress made so far
+        self.stopped.set()
+        self.executor.shutdown(wait=True)
+        self.db_manager.close()
+
+    def throttle(self, size):
+        if not self.max_bytes_per_second:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.budget_time = max(self.budget_time, now) + size / self.max_bytes_per_second
+            delay = self.budget_time - now
+        if delay > 0:
+            self.stopped.wait(delay)
+
+    def run(self, model_path):
+        try:
+            content_hash = self.hash_file(model_path)
+            if content_hash is not None:
+                duplicate_of = self.db_manager.save_model_hash(model_path, content_hash)
+                if duplicate_of and self.on_duplicate is not None:
+                    self.on_duplicate(model_path, duplicate_of)
+        except (OSError, ValueError) as e:
+            print("Error occurred while hashing {}: {}".format(model_path, e))
+        finally:
+            # Pool threads come and go, so each job hands its connection back
+            self.db_manager.close_thread_connection()
+            with self.lock:
+                self.pending.discard(model_path)
+
+    def hash_file(self, model_path):
+        stat = os.stat(model_path)
+        # Progress is only reused while the file is unchanged
+        signature = "{}:{}".format(stat.st_size, int(stat.st_mtime))
+        progress = self.db_manager.get_hash_progress(model_path) or ""
+        saved_signature, _, digests = progress.partition("|")
+        chunk_digests = digests.split(",") if saved_signature == signature and digests else []
+        if stat.st_size == 0:
+            return combine_chunk_digests([hashlib.sha256(b"").hexdigest()])
+
+        with open(model_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            if hasattr(mapped, "madvise"):
+                mapped.madvise(mmap.MADV_SEQUENTIAL)
+            with memoryview(mapped) as view:
+                for chunk_start in range(len(chunk_digests) * self.chunk_size, stat.st_size, self.chunk_size):
+                    chunk_end = min(chunk_start + self.chunk_size, stat.st_size)
+                    digest = hashlib.sha256()
+                    for start in range(chunk_start, chunk_end, READ_SIZE):
+                        if self.stopped.is_set():
+                            return None
+                        with view[start:min(start + READ_SIZE, chunk_end)] as piece:
+                            digest.update(piece)
+                        self.throttle(min(READ_SIZE, chunk_end - start))
+                    chunk_digests.append(digest.hexdigest())
+                    self.db_manager.save_hash_progress(model_path, signature + "|" + ",".join(chunk_digests))
+                    if hasattr(os, "posix_fadvise"):
+                        # Hashed pages are not needed again, keep them from pushing loaded models out of the page cache
+                        os.posix_fadvise(f.fileno(), chunk_start, chunk_end - chunk_start, os.POSIX_FADV_DONTNEED)
+        return combine_chunk_digests(chunk_digests)
@@ -0,0 +1,73 @@
+import os
+import threading
+from collections import OrderedDict
+
+from backends import get_backend
+
+class ModelManager:
+    def __init__(self, max_memory=8 * 1024 ** 3):
+        # Resident-memory budget in bytes shared by every loaded model
+        self.max_memory = max_memory
+        # Loaded engines keyed by (model identity, chat_format, embedding, llama options, backend), least recently used first.
+        # The identity is the content hash when known, so copies of the same file share one instance
+        self.models = OrderedDict()
+        self.sizes = {}
+        self.paths = {}
+        self.lock = threading.Lock()
+
+    def estimate_size(self, model_path):
+        # The weights dominate resident memory, so the file size is a good estimate
+        try:
+            return os.path.getsize(model_path)
+        except OSError:
+            return 0
+
+    def make_key(self, model_path, chat_format, embedding, llama_options, backend, model_hash):
+        return (model_hash or model_path, chat_format, embedding, tuple(sorted(dict(llama_options or {}).items())),
+                get_backend(backend).name)
+
+    def get_model(self, model_path, chat_format, embedding=False, llama_options=None, backend=None, model_hash=None):
+        llama_options = dict(llama_options or {})
+        backend = get_backend(backend).name
+        key = self.make_key(model_path, chat_format, embedding, llama_options, backend, model_hash)
+        with self.lock:
+            if key in self.models:
+                # Mark as most recently used and hand back the resident instance
+                self.models.move_to_end(key)
+                return self.models[key]
+
+            llm = get_backend(backend).create_engine(model_path, chat_format, embedding=embedding, **llama_options)
+            self.models[key] = llm
+            self.sizes[key] = self.estimate_size(model_path)
+            self.paths[key] = model_path
+            self.evict()
+            return llm
+
+    def evict(self):
+        # Drop least recently used models until we fit the budget, always keeping the newest
+        while len(self.models) > 1 and self.memory_used() > self.max_memory:
+            key, _ = self.models.popitem(last=False)
+            self.sizes.pop(key, None)
+            print("Evicted model from memory:", self.paths.pop(key, key[0]))
+
+    def memory_used(self):
+        # Instances of the same file share its memory-mapped weights, so count each file once
+        return sum(dict((key[0], size) for key, size in self.sizes.items()).values())
+
+    def is_loaded(self, model_path, chat_format, embedding=False, llama_options=None, backend=None, model_hash=None):
+        key = self.make_key(model_path, chat_format, embedding, llama_options, backend, model_hash)
+        with self.lock:
+            return key in self.models
+
+    def unload(self, model_path):
+        # Forget every cached instance of the given model file
+        with self.lock:
+            for key in [key for key in self.models if self.paths.get(key) == model_path]:
+                del self.models[key]
+                self.sizes.pop(key, None)
+                self.paths.pop(key, None)
+
+    def set_max_memory(self, max_memory):
+        with self.lock:
+            self.max_memory = max_memory
+            self.evict()
@@ -0,0 +1,68 @@
+import os
+import re
+
+from ggufReader import read_gguf_metadata
+
+# Later shards of a split model (name-00002-of-00003.gguf) are loaded through the first one
+SHARD_PATTERN = re.compile(r"-(\d{5})-of-\d{5}\.gguf$", re.IGNORECASE)
+
+class ModelDirectoryScanner:
+    def __init__(self, db_manager, batch_size=50):
+        # Finds .gguf files under the watched directories and keeps the Model table in step with them
+        self.db_manager = db_manager
+        self.batch_size = batch_size
+        # Unreadable files by (size, mtime), so they are not retried until they change
+        self.failed = {}
+
+    def find_models(self, directory):
+        for root, dirs, files in os.walk(directory):
+            dirs[:] = [name for name in dirs if not name.startswith(".")]
+            for name in files:
+                if not name.lower().endswith(".gguf"):
+                    continue
+                shard = SHARD_PATTERN.search(name)
+                if shard and int(shard.group(1)) != 1:
+                    continue
+                path = os.path.join(root, name).replace(os.sep, "/")
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                yield path, stat.st_size, stat.st_mtime
+
+    def scan(self, on_batch=None):
+        # Files whose size and mtime match the index are skipped, only new or changed headers are read.
+        # on_batch(rows, removed) is called after each committed batch
+        known = self.db_manager.fetch_model_files()
+        directories = self.db_manager.fetch_watched_directories()
+        seen = set()
+        added, updated = [], []
+        for directory in directories:
+            if not os.path.isdir(directory):
+                # Leave the models of a folder that is temporarily unavailable (unmounted share) alone
+                seen.update(path for path, (_, _, source_dir) in known.items() if source_dir == directory)
+                continue
+            for path, size, mtime in self.find_models(directory):
+                seen.add(path)
+                if path in known and known[path][:2] == (size, mtime) or self.failed.get(path) == (size, mtime):
+                    continue
+                try:
+                    metadata = read_gguf_metadata(path)
+                except (OSError, ValueError) as e:
+                    print("Skipping {}: {}".format(path, e))
+                    self.failed[path] = (size, mtime)
+                    continue
+                (updated if path in known else added).append((path, size, mtime, directory, metadata))
+                if len(added) + len(updated) >= self.batch_size:
+                    self.commit(added, updated, [], on_batch)
+                    added, updated = [], []
+        # Only files found by a scan are removed, models added by hand stay
+        removed = [path for path, (_, _, source_dir) in known.items()
+                   if source_dir is not None and path not in seen]
+        if added or updated or removed:
+            self.commit(added, updated, removed, on_batch)
+
+    def commit(self, added, updated, removed, on_batch):
+        rows = self.db_manager.apply_model_scan(added, updated, removed)
+        if on_batch is not None:
+            on_batch(rows, removed)
@@ -0,0 +1,213 @@
+import multiprocessing
+import os
+import threading
+
+class PipeEvent:
+    # Reads as set once the parent has sent something, which during generation can only be a cancel
+    def __init__(self, conn):
+        self.conn = conn
+
+    def is_set(self):
+        return self.conn.poll()
+
+def worker_main(conn, model_path, chat_format, options):
+    # Runs in the child process: load the model once, then answer requests until told to stop
+    if options.get("cpu_affinity") and hasattr(os, "sched_setaffinity"):
+        # Pin before llama.cpp starts its threads so they inherit the CPU set
+        os.sched_setaffinity(0, options["cpu_affinity"])
+
+    from chatModel import ChatModel
+    from database import DatabaseManager
+    from responseCache import ResponseCache
+    from sessionState import SessionStateStore
+
+    model_options = {
+        "sampling_params": options.get("sampling_params"),
+        "semantic_threshold": options.get("semantic_threshold"),
+        "llama_options": options.get("llama_options"),
+        "speculative": options.get("speculative"),
+        "backend": options.get("backend"),
+        "model_hash": options.get("model_hash"),
+    }
+    if options.get("state_dir"):
+        model_options["state_store"] = SessionStateStore(options["state_dir"])
+    if options.get("db_name"):
+        model_options["response_cache"] = ResponseCache(DatabaseManager(options["db_name"]))
+    try:
+        model = ChatModel(model_path=model_path, chat_format=chat_format, **model_options)
+    except Exception as e:
+        conn.send(("error", str(e)))
+        return
+    conn.send(("ready", model.model_hash))
+    # A cancel also aborts a prompt evaluation that is under way
+    model.abort_event = PipeEvent(conn)
+    # Requests may override sampling settings, anything they leave out keeps the worker's default
+    default_sampling_params = dict(model.sampling_params)
+
+    while True:
+        try:
+            command = conn.recv()
+        except EOFError:
+            model.close()
+            return
+        if command[0] == "stop":
+            # Write the last session's state before the process exits
+            model.close()
+            return
+        if command[0] != "generate":
+            continue
+        _, question, messages, session_id, resume, sampling_params = command
+        model.sampling_params = dict(default_sampling_params, **(sampling_params or {}))
+        if resume:
+            model.resume_session(session_id, messages)
+        else:
+            model.reset_conversation(messages)
+            model.session_id = session_id
+        try:
+            tokens = model.generate_response(question, stream=True)
+            for token in tokens:
+                conn.send(("token", token))
+                # Stop early when the parent cancels the request
+                if conn.poll() and conn.recv()[0] == "cancel":
+                    tokens.close()
+                    break
+            conn.send(("cache_stats", model.cache_stats()))
+            conn.send(("speculative_stats", model.speculative_stats()))
+            # A cancelled reply is part of the conversation up to where it stopped
+            conn.send(("done", model.messages))
+        except Exception as e:
+            conn.send(("error", str(e)))
+
+class ProcessChatModel:
+    def __init__(self, model_path, chat_format, options=None):
+        # Same interface as ChatModel, but llama.cpp runs in a child process so a crash
+        # or a long native call never takes the GUI down with it
+        self.model_path = model_path
+        self.chat_format = chat_format
+        self.options = dict(options or {})
+        self.messages = []
+        self.session_id = None
+        self.resume_pending = False
+        self.model_hash = None
+        self.context = multiprocessing.get_context("spawn")
+        self.process = None
+        self.conn = None
+        self.lock = threading.Lock()
+        # Set by the caller to stop generating, checked while waiting for the worker too
+        self.abort_event = None
+        self.restarts = 0
+        self.closed = False
+        # Cache and speculation counters as the worker reported them after its last request, None before its first one
+        self.last_cache_stats = None
+        self.last_speculative_stats = None
+        self.start_process()
+
+    def start_process(self):
+        parent_conn, child_conn = self.context.Pipe()
+        self.process = self.context.Process(target=worker_main, args=(child_conn, self.model_path, self.chat_format, self.options),
+                                            daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.conn = parent_conn
+        try:
+            message = self.conn.recv()
+        except EOFError:
+            raise RuntimeError("Inference worker exited while loading the model")
+        if message[0] == "error":
+            raise RuntimeError(message[1])
+        self.model_hash = message[1]
+
+    def ensure_running(self):
+        # Restart the worker if it crashed since the last request
+        if self.closed:
+            raise RuntimeError("Inference worker has been closed")
+        if self.process is None or not self.process.is_alive():
+            self.restarts += 1
+            print("Restarting inference worker (restart {})".format(self.restarts))
+            self.start_process()
+            # The new process has an empty KV cache, so let it restore the saved session state
+            self.resume_pending = self.session_id is not None
+
+    def reset_conversation(self, messages=None):
+        self.messages = list(messages or [])
+
+    def resume_session(self, session_id, messages):
+        self.session_id = session_id
+        self.reset_conversation(messages)
+        self.resume_pending = True
+
+    def generate_response(self, user_question, stream=False):
+        tokens = self.stream_response(user_question)
+        if stream:
+            return tokens
+        return "".join(tokens)
+
+    def stream_response(self, user_question, messages=None, session_id=None, sampling_params=None):
+        with self.lock:
+            if messages is not None:
+                # Callers sharing this worker pass their own conversation with each request
+                self.messages = list(messages)
+                self.session_id = session_id
+            self.ensure_running()
+            self.conn.send(("generate", user_question, self.messages, self.session_id, self.resume_pending,
+                            sampling_params))
+            self.resume_pending = False
+            finished = False
+            cancel_sent = False
+            try:
+                while True:
+                    try:
+                        # No token arrives while the prompt is evaluated, so watch for a cancel meanwhile
+                        while self.abort_event is not None and not cancel_sent and not self.conn.poll(0.1):
+                            if self.abort_event.is_set():
+                                self.conn.send(("cancel",))
+                                cancel_sent = True
+                        kind, value = self.conn.recv()
+                    except (EOFError, OSError):
+                        self.process.join(1)
+                        raise RuntimeError("Inference worker crashed with exit code {}".format(self.process.exitcode))
+                    if kind == "token":
+                        yield value
+                    elif kind == "cache_stats":
+                        self.last_cache_stats = value
+                    elif kind == "speculative_stats":
+                        self.last_speculative_stats = value
+                    elif kind == "done":
+                        finished = True
+                        if value is not None:
+                            self.messages = value
+                        return
+                    elif kind == "error":
+                        finished = True
+                        raise RuntimeError(value)
+            finally:
+                if not finished and self.process.is_alive():
+                    # The caller stopped reading, cancel and drain until the worker is idle again
+                    self.conn.send(("cancel",))
+                    while True:
+                        try:
+                            kind, value = self.conn.recv()
+                        except (EOFError, OSError):
+                            break
+                        if kind == "done":
+                            # The conversation now ends with the stopped reply
+                            self.messages = value
+                        if kind in ("done", "error"):
+                            break
+
+    def cache_stats(self):
+        return self.last_cache_stats
+
+    def speculative_stats(self):
+        return self.last_speculative_stats
+
+    def close(self):
+        self.closed = True
+        if self.process is not None and self.process.is_alive():
+            try:
+                self.conn.send(("stop",))
+            except OSError:
+                pass
+            self.process.join(5)
+            if self.process.is_alive():
+                self.process.terminate()
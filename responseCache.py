@@ -0,0 +1,55 @@
+import hashlib
+import json
+import threading
+import time
+
+class ResponseCache:
+    def __init__(self, db_manager, max_entries=1000, max_bytes=16 * 1024 * 1024):
+        # Exact-match answers stored in the ResponseCache table of the app database
+        self.db_manager = db_manager
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def is_deterministic(sampling_params):
+        # Only greedy decoding or a fixed seed gives the same answer every time
+        return sampling_params.get("temperature", 0.2) <= 0 or sampling_params.get("seed") is not None
+
+    @staticmethod
+    def normalize(text):
+        # Ignore differences in case and whitespace between otherwise identical prompts
+        return " ".join(text.split()).casefold()
+
+    def make_key(self, model_hash, chat_format, sampling_params, messages):
+        key = json.dumps({
+            "model": model_hash,
+            "format": chat_format,
+            "sampling": sampling_params,
+            "messages": [[message["role"], self.normalize(message["content"])] for message in messages],
+        }, sort_keys=True)
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+    def get(self, cache_key):
+        response = self.db_manager.get_cached_response(cache_key, time.time())
+        with self.lock:
+            if response is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return response
+
+    def put(self, cache_key, model_hash, chat_format, response):
+        self.db_manager.save_cached_response(cache_key, model_hash, chat_format, response, time.time(),
+                                             self.max_entries, self.max_bytes)
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+            }
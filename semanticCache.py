@@ -0,0 +1,135 @@
+import json
+import os
+import threading
+import time
+
+import numpy as np
+
+class SemanticCache:
+    def __init__(self, directory='semantic_cache', model_hash='default', capacity=1000, threshold=0.92):
+        # One vector index per model, embeddings from different models are not comparable
+        self.directory = os.path.join(directory, model_hash)
+        self.capacity = capacity
+        self.threshold = threshold
+        self.vectors_path = os.path.join(self.directory, "vectors.npy")
+        self.entries_path = os.path.join(self.directory, "entries.json")
+        self.vectors = None
+        # entries[i] describes row i of the vector matrix, None for a free slot
+        self.entries = [None] * capacity
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+        self.load()
+
+    def load(self):
+        if not (os.path.exists(self.vectors_path) and os.path.exists(self.entries_path)):
+            return
+        try:
+            vectors = np.load(self.vectors_path, mmap_mode="r+")
+            with open(self.entries_path, "r", encoding="utf-8") as f:
+                entries = json.load(f)
+        except (OSError, ValueError) as e:
+            print("Error occurred while loading semantic cache:", e)
+            return
+        if vectors.shape[0] != self.capacity:
+            # Capacity changed, keep the most recently used rows that still fit
+            used = sorted((i for i, entry in enumerate(entries) if entry), key=lambda i: entries[i]["last_used"], reverse=True)
+            used = used[:self.capacity]
+            # Copy the old rows out before the file is recreated with the new shape
+            vectors = np.array(vectors[used])
+            self.create_vectors(vectors.shape[1])
+            for row, i in enumerate(used):
+                self.vectors[row] = vectors[row]
+                self.entries[row] = entries[i]
+            self.save()
+        else:
+            self.vectors = vectors
+            self.entries = entries
+
+    def create_vectors(self, dim):
+        # Contiguous float32 matrix backed by a memory-mapped .npy file
+        self.vectors = np.lib.format.open_memmap(self.vectors_path, mode="w+", dtype=np.float32, shape=(self.capacity, dim))
+        self.entries = [None] * self.capacity
+
+    def save(self):
+        self.vectors.flush()
+        with open(self.entries_path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(self.entries, f)
+        os.replace(self.entries_path + ".tmp", self.entries_path)
+
+    @staticmethod
+    def normalize(vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if vectors.ndim == 1:
+            vectors = vectors[np.newaxis, :]
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-12)
+
+    def search(self, queries):
+        # Cosine similarity of every query against every cached vector in one matrix product.
+        # Returns (best_rows, best_scores) with a row of -1 where the cache is empty
+        with self.lock:
+            return self.best_matches(queries)
+
+    def best_matches(self, queries):
+        # search() without taking the lock, for callers that already hold it
+        queries = self.normalize(queries)
+        if self.vectors is None:
+            return np.full(len(queries), -1), np.full(len(queries), -1.0, dtype=np.float32)
+        used = np.fromiter((entry is not None for entry in self.entries), dtype=bool, count=self.capacity)
+        if not used.any():
+            return np.full(len(queries), -1), np.full(len(queries), -1.0, dtype=np.float32)
+        scores = queries @ self.vectors.T
+        scores[:, ~used] = -np.inf
+        best_rows = np.argmax(scores, axis=1)
+        best_scores = scores[np.arange(len(queries)), best_rows]
+        return best_rows, best_scores
+
+    @staticmethod
+    def check_vector(embedding):
+        # lookup and add take one prompt's embedding, a matrix would be read as a batch of prompts
+        embedding = np.asarray(embedding, dtype=np.float32)
+        if embedding.ndim != 1:
+            raise ValueError("Expected a single embedding vector, got shape {}".format(embedding.shape))
+        return embedding
+
+    def lookup(self, embedding):
+        embedding = self.check_vector(embedding)
+        # Search and read under one lock hold, so a concurrent add cannot evict the matched row in between
+        with self.lock:
+            best_rows, best_scores = self.best_matches(embedding)
+            row, score = int(best_rows[0]), float(best_scores[0])
+            if row >= 0 and score >= self.threshold:
+                self.hits += 1
+                entry = self.entries[row]
+                entry["last_used"] = time.time()
+                return entry["response"]
+            self.misses += 1
+            return None
+
+    def add(self, embedding, prompt, response):
+        vector = self.normalize(self.check_vector(embedding))[0]
+        with self.lock:
+            if self.vectors is None:
+                self.create_vectors(vector.shape[0])
+            # Use a free slot, otherwise evict the least recently used entry
+            free = [i for i, entry in enumerate(self.entries) if entry is None]
+            if free:
+                row = free[0]
+            else:
+                row = min(range(self.capacity), key=lambda i: self.entries[i]["last_used"])
+            self.vectors[row] = vector
+            now = time.time()
+            self.entries[row] = {"prompt": prompt, "response": response, "created": now, "last_used": now}
+            self.save()
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                "entries": sum(entry is not None for entry in self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+            }
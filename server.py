@@ -0,0 +1,344 @@
+import argparse
+import asyncio
+import json
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from database import DatabaseManager
+from ggufReader import resolve_chat_format
+
+class ChatModelBackend:
+    def __init__(self, model):
+        self.model = model
+        self.name = model.model_path.split('/')[-1]
+
+    def generate(self, messages, sampling_params):
+        # Each request carries its own history, so the model starts from that conversation
+        self.model.reset_conversation(messages[:-1])
+        self.model.session_id = None
+        self.model.sampling_params = sampling_params
+        return self.model.generate_response(messages[-1]["content"], stream=True)
+
+    def stats(self):
+        stats = getattr(self.model, "speculative_stats", None)
+        return {"speculative": stats() if stats else None, "caches": self.model.cache_stats()}
+
+class BatchEngineBackend:
+    def __init__(self, engine, name):
+        # Several requests decode together in one llama context
+        self.engine = engine
+        self.name = name
+        self.concurrency = engine.n_slots
+
+    def generate(self, messages, sampling_params):
+        request = self.engine.submit(messages, **sampling_params)
+        try:
+            for text in request:
+                yield text
+        finally:
+            # Stop decoding for requests whose client has gone away
+            request.cancel()
+
+    def stats(self):
+        return self.engine.stats()
+
+class WorkerPoolBackend:
+    def __init__(self, pool, name):
+        # Requests are spread over several model processes
+        self.pool = pool
+        self.name = name
+        self.concurrency = pool.n_workers
+
+    def generate(self, messages, sampling_params):
+        return self.pool.generate(messages[-1]["content"], messages[:-1], stream=True, sampling_params=sampling_params)
+
+    def stats(self):
+        return self.pool.stats()
+
+class StubBackend:
+    def __init__(self, delay=0.0):
+        # Deterministic backend for trying the server without loading a model
+        self.name = "stub"
+        self.delay = delay
+
+    def generate(self, messages, sampling_params):
+        reply = "This is a stub reply to: " + messages[-1]["content"]
+        for word in reply.split(" "):
+            if self.delay:
+                time.sleep(self.delay)
+            yield word + " "
+
+class LatencyMetrics:
+    def __init__(self, window=1000):
+        self.window = window
+        self.requests = 0
+        self.rejected = 0
+        self.errors = 0
+        self.total_times = []
+        self.first_token_times = []
+        self.queue_times = []
+        self.lock = threading.Lock()
+
+    def record(self, queue_time, first_token_time, total_time):
+        with self.lock:
+            self.requests += 1
+            for values, value in ((self.queue_times, queue_time), (self.first_token_times, first_token_time),
+                                  (self.total_times, total_time)):
+                if value is not None:
+                    values.append(value)
+                    del values[:-self.window]
+
+    @staticmethod
+    def percentiles(values):
+        if not values:
+            return {}
+        values = sorted(values)
+        pick = lambda p: values[min(len(values) - 1, int(p * len(values)))]
+        return {"p50": pick(0.5), "p95": pick(0.95), "p99": pick(0.99), "max": values[-1]}
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "requests": self.requests,
+                "rejected": self.rejected,
+                "errors": self.errors,
+                "queue_time": self.percentiles(self.queue_times),
+                "time_to_first_token": self.percentiles(self.first_token_times),
+                "total_time": self.percentiles(self.total_times),
+            }
+
+class ChatServer:
+    def __init__(self, backend, host="127.0.0.1", port=8000, max_queue=16):
+        self.backend = backend
+        self.host = host
+        self.port = port
+        # Requests waiting for the model, anything beyond this is rejected with 503
+        self.requests = None
+        self.max_queue = max_queue
+        self.metrics = LatencyMetrics()
+        # Backends that batch sequences can serve several requests at once, the rest serve one at a time
+        self.concurrency = getattr(backend, "concurrency", 1)
+        self.executor = ThreadPoolExecutor(max_workers=self.concurrency)
+
+    async def start(self):
+        self.requests = asyncio.Queue(maxsize=self.max_queue)
+        self.dispatcher = asyncio.ensure_future(self.dispatch())
+        self.server = await asyncio.start_server(self.handle_connection, self.host, self.port)
+        print("Serving {} on http://{}:{}".format(self.backend.name, self.host, self.port))
+        return self.server
+
+    async def serve_forever(self):
+        server = await self.start()
+        async with server:
+            await server.serve_forever()
+
+    async def dispatch(self):
+        # Start queued requests as soon as the backend has capacity, streaming tokens back to their connections
+        loop = asyncio.get_running_loop()
+        slots = asyncio.Semaphore(self.concurrency)
+        while True:
+            job = await self.requests.get()
+            await slots.acquire()
+            job["started"] = time.perf_counter()
+            future = loop.run_in_executor(self.executor, self.produce, loop, job)
+            future.add_done_callback(lambda _: slots.release())
+
+    def produce(self, loop, job):
+        tokens = job["tokens"]
+        generator = self.backend.generate(job["messages"], job["sampling_params"])
+        try:
+            for token in generator:
+                if job["cancelled"]:
+                    break
+                loop.call_soon_threadsafe(tokens.put_nowait, token)
+        except Exception as e:
+            print("Error:", e)
+            loop.call_soon_threadsafe(tokens.put_nowait, e)
+        finally:
+            if hasattr(generator, "close"):
+                generator.close()
+        loop.call_soon_threadsafe(tokens.put_nowait, None)
+
+    async def handle_connection(self, reader, writer):
+        try:
+            request_line = await reader.readline()
+            if not request_line:
+                return
+            method, path, _ = request_line.decode("latin-1").split(" ", 2)
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, _, value = line.decode("latin-1").partition(":")
+                headers[name.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+            if method == "GET" and path == "/v1/models":
+                await self.send_json(writer, 200, {"object": "list", "data": [{"id": self.backend.name, "object": "model"}]})
+            elif method == "GET" and path == "/metrics":
+                metrics = self.metrics.snapshot()
+                metrics["queue_depth"] = self.requests.qsize()
+                if hasattr(self.backend, "stats"):
+                    metrics["backend"] = self.backend.stats()
+                await self.send_json(writer, 200, metrics)
+            elif method == "POST" and path == "/v1/chat/completions":
+                await self.chat_completions(writer, json.loads(body or b"{}"))
+            else:
+                await self.send_json(writer, 404, {"error": {"message": "Not found"}})
+        except (ValueError, KeyError) as e:
+            await self.send_json(writer, 400, {"error": {"message": str(e)}})
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def send_json(self, writer, status, payload):
+        body = json.dumps(payload).encode("utf-8")
+        writer.write(self.headers(status, "application/json", len(body)) + body)
+        await writer.drain()
+
+    @staticmethod
+    def headers(status, content_type, length=None):
+        reasons = {200: "OK", 400: "Bad Request", 404: "Not Found", 500: "Internal Server Error", 503: "Service Unavailable"}
+        lines = ["HTTP/1.1 {} {}".format(status, reasons[status]), "Content-Type: " + content_type, "Connection: close"]
+        if length is not None:
+            lines.append("Content-Length: {}".format(length))
+        return ("\r\n".join(lines) + "\r\n\r\n").encode("utf-8")
+
+    async def chat_completions(self, writer, request):
+        messages = request["messages"]
+        if not messages:
+            raise ValueError("messages must not be empty")
+        sampling_params = {key: request[key] for key in ("temperature", "top_p", "max_tokens", "seed", "stop") if key in request}
+        job = {
+            "messages": messages,
+            "sampling_params": sampling_params,
+            "tokens": asyncio.Queue(),
+            "cancelled": False,
+            "received": time.perf_counter(),
+        }
+        try:
+            self.requests.put_nowait(job)
+        except asyncio.QueueFull:
+            self.metrics.rejected += 1
+            await self.send_json(writer, 503, {"error": {"message": "Server busy, too many queued requests"}})
+            return
+
+        completion_id = "chatcmpl-" + uuid.uuid4().hex
+        created = int(time.time())
+        stream = request.get("stream", False)
+        first_token_time = None
+        content = ""
+        try:
+            if stream:
+                writer.write(self.headers(200, "text/event-stream"))
+            while True:
+                token = await job["tokens"].get()
+                if token is None:
+                    break
+                if isinstance(token, Exception):
+                    raise token
+                if first_token_time is None:
+                    first_token_time = time.perf_counter() - job["received"]
+                content += token
+                if stream:
+                    chunk = {
+                        "id": completion_id, "object": "chat.completion.chunk", "created": created, "model": self.backend.name,
+                        "choices": [{"index": 0, "delta": {"content": token}, "finish_reason": None}],
+                    }
+                    writer.write(b"data: " + json.dumps(chunk).encode("utf-8") + b"\n\n")
+                    await writer.drain()
+        except ConnectionError:
+            # Client went away, stop generating for it
+            job["cancelled"] = True
+            return
+        except Exception as e:
+            self.metrics.errors += 1
+            if not stream:
+                await self.send_json(writer, 500, {"error": {"message": str(e)}})
+            return
+
+        total_time = time.perf_counter() - job["received"]
+        queue_time = job["started"] - job["received"]
+        self.metrics.record(queue_time, first_token_time, total_time)
+        print("Request {} queued {:.3f}s, first token {}, total {:.3f}s".format(
+            completion_id, queue_time, "{:.3f}s".format(first_token_time) if first_token_time is not None else "-", total_time))
+
+        if stream:
+            final = {
+                "id": completion_id, "object": "chat.completion.chunk", "created": created, "model": self.backend.name,
+                "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}],
+            }
+            writer.write(b"data: " + json.dumps(final).encode("utf-8") + b"\n\ndata: [DONE]\n\n")
+            await writer.drain()
+        else:
+            await self.send_json(writer, 200, {
+                "id": completion_id, "object": "chat.completion", "created": created, "model": self.backend.name,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": content.strip()}, "finish_reason": "stop"}],
+            })
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve the active ScriptSage model with an OpenAI-compatible API.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--model", help="GGUF model path, defaults to the active model in the app database")
+    parser.add_argument("--chat-format", help="defaults to the format detected from the GGUF header")
+    parser.add_argument("--backend", help="inference backend, defaults to the one recorded for the model or llama_cpp")
+    parser.add_argument("--max-queue", type=int, default=16, help="requests allowed to wait before new ones are rejected")
+    parser.add_argument("--stub", action="store_true", help="answer with a deterministic stub instead of a model")
+    parser.add_argument("--batch-slots", type=int, default=0,
+                        help="decode this many requests together in one context with continuous batching")
+    parser.add_argument("--slot-ctx", type=int, default=2048, help="context size of each batching slot")
+    parser.add_argument("--speculative", help="speculative decoding: \"lookup\" for prompt lookup or a draft GGUF path, "
+                                              "defaults to the model's setting")
+    parser.add_argument("--workers", type=int, default=0, help="serve requests from this many model processes")
+    parser.add_argument("--threads-per-worker", type=int, help="llama.cpp threads in each worker process")
+    parser.add_argument("--no-pin", action="store_true", help="do not pin worker processes to CPU blocks")
+    args = parser.parse_args()
+
+    if args.stub:
+        backend = StubBackend()
+    else:
+        db_manager = DatabaseManager()
+        db_manager.create_database()
+        model_path = args.model or db_manager.get_active_model_path()
+        if not model_path:
+            parser.error("no --model given and no active model found")
+        chat_format = args.chat_format or resolve_chat_format(model_path, db_manager)
+        model_hash = db_manager.get_model_hash(model_path)
+        backend_name = args.backend or db_manager.get_model_backend(model_path)
+        speculative = args.speculative or db_manager.get_model_speculative(model_path)
+        if args.batch_slots:
+            from batchEngine import BatchEngine
+            engine = BatchEngine.from_model_path(model_path, chat_format, n_slots=args.batch_slots,
+                                                 n_ctx_per_slot=args.slot_ctx, backend=backend_name)
+            engine.start()
+            backend = BatchEngineBackend(engine, model_path.split('/')[-1])
+        elif args.workers:
+            from workerPool import WorkerPool
+            pool = WorkerPool(model_path, chat_format, n_workers=args.workers, n_threads=args.threads_per_worker,
+                              pin_cpus=not args.no_pin, options={"speculative": speculative, "model_hash": model_hash,
+                                                                  "backend": backend_name, "db_name": db_manager.db_name})
+            backend = WorkerPoolBackend(pool, model_path.split('/')[-1])
+        else:
+            from backends import create_chat_model
+            from cpuTuner import host_id, tuning_options
+            from responseCache import ResponseCache
+            llama_options = tuning_options(db_manager.get_model_tuning(model_path, host_id()))
+            # Deterministic requests are answered from the app's response cache, its hit rate is in /metrics
+            model = create_chat_model(backend_name, model_path, chat_format, speculative=speculative,
+                                      llama_options=llama_options, model_hash=model_hash,
+                                      response_cache=ResponseCache(db_manager))
+            backend = ChatModelBackend(model)
+
+    server = ChatServer(backend, args.host, args.port, args.max_queue)
+    try:
+        asyncio.run(server.serve_forever())
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+import os
+import pickle
+import threading
+import zlib
+
+import numpy as np
+
+class SessionStateStore:
+    def __init__(self, directory='states', max_bytes=2 * 1024 ** 3, max_files=50):
+        # Saved llama states live in one file per (session, model) pair
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        self.lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+
+    def state_path(self, session_id, model_hash):
+        return os.path.join(self.directory, "{}-{}.state".format(session_id, model_hash))
+
+    def save(self, session_id, model_hash, state, messages):
+        # Only the logits of the last evaluated token are needed to continue generating,
+        # so drop the rest of the score matrix and compress the KV state.
+        # llama-cpp-python 0.2 saves all n_ctx rows of scores, 0.3 only the evaluated ones up to n_batch,
+        # and load_state wants them back in the same shape
+        n_tokens = state.n_tokens
+        last_row = min(n_tokens, state.scores.shape[0]) - 1
+        blob = {
+            "n_tokens": n_tokens,
+            "input_ids": state.input_ids[:n_tokens].copy(),
+            "n_ctx": state.input_ids.shape[0],
+            "scores_shape": state.scores.shape,
+            "last_row": last_row,
+            "last_scores": state.scores[last_row].copy() if last_row >= 0 else None,
+            "llama_state": zlib.compress(state.llama_state, 1),
+            "llama_state_size": state.llama_state_size,
+            # Only 0.3 states carry the sampling seed
+            "seed": getattr(state, "seed", None),
+            "messages": messages,
+        }
+        path = self.state_path(session_id, model_hash)
+        with self.lock:
+            # Write to a temporary file first so a crash never leaves a half-written state
+            with open(path + ".tmp", "wb") as f:
+                pickle.dump(blob, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(path + ".tmp", path)
+            self.evict()
+
+    def load(self, session_id, model_hash):
+        # Returns (LlamaState, messages) or None when nothing was saved
+        path = self.state_path(session_id, model_hash)
+        with self.lock:
+            try:
+                with open(path, "rb") as f:
+                    blob = pickle.load(f)
+            except (OSError, pickle.UnpicklingError, EOFError) as e:
+                if not isinstance(e, FileNotFoundError):
+                    print("Error occurred while loading session state:", e)
+                return None
+            # Touch the file so eviction treats it as recently used
+            os.utime(path)
+
+        # Only llama_cpp engines save states, so import it once there is one to restore
+        from llama_cpp import LlamaState
+        n_tokens = blob["n_tokens"]
+        input_ids = np.zeros((blob["n_ctx"],), dtype=np.intc)
+        input_ids[:n_tokens] = blob["input_ids"]
+        # Files written before the shape was recorded hold a full (n_ctx, n_vocab) matrix
+        scores = np.zeros(blob.get("scores_shape") or (blob["n_ctx"], blob["n_vocab"]), dtype=np.single)
+        last_row = blob.get("last_row", n_tokens - 1)
+        if last_row >= 0:
+            scores[last_row] = blob["last_scores"]
+        options = {"seed": blob["seed"]} if blob.get("seed") is not None else {}
+        state = LlamaState(
+            input_ids=input_ids,
+            scores=scores,
+            n_tokens=n_tokens,
+            llama_state=zlib.decompress(blob["llama_state"]),
+            llama_state_size=blob["llama_state_size"],
+            **options
+        )
+        return state, blob["messages"]
+
+    def remove_session(self, session_id):
+        prefix = "{}-".format(session_id)
+        with self.lock:
+            for name in os.listdir(self.directory):
+                if name.startswith(prefix) and name.endswith(".state"):
+                    os.remove(os.path.join(self.directory, name))
+
+    def evict(self):
+        # Remove the least recently used state files until both limits are met
+        files = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".state"):
+                path = os.path.join(self.directory, name)
+                stat = os.stat(path)
+                files.append((stat.st_mtime, stat.st_size, path))
+        files.sort()
+        total = sum(size for _, size, _ in files)
+        while files and (total > self.max_bytes or len(files) > self.max_files):
+            _, size, path = files.pop(0)
+            os.remove(path)
+            total -= size
@@ -0,0 +1,86 @@
+import threading
+
+import numpy as np
+
+# llama.cpp is imported where a drafter is built, Llama only needs draft models to be callable
+
+class DraftModelDecoding:
+    def __init__(self, model_path, num_pred_tokens=8, n_ctx=512, **llama_options):
+        # A small model with the same vocabulary guesses the next tokens greedily
+        from llama_cpp import Llama
+        self.model_path = model_path
+        self.num_pred_tokens = num_pred_tokens
+        self.llm = Llama(model_path=model_path, n_ctx=n_ctx, verbose=False, **llama_options)
+
+    def __call__(self, input_ids, **kwargs):
+        # Keep the tail of long contexts so the draft model's window is never exceeded
+        tokens = input_ids[-(self.llm.n_ctx() - self.num_pred_tokens):].tolist()
+        if not tokens:
+            return np.array([], dtype=np.intc)
+        draft = []
+        # generate() reuses the draft model's KV cache for the prefix it has already seen
+        generator = self.llm.generate(tokens, temp=0.0, reset=True)
+        try:
+            for token in generator:
+                if token == self.llm.token_eos():
+                    break
+                draft.append(token)
+                if len(draft) >= self.num_pred_tokens:
+                    break
+        finally:
+            generator.close()
+        return np.array(draft, dtype=np.intc)
+
+class SpeculativeDecoding:
+    def __init__(self, drafter):
+        # Wraps a drafter and counts how many of its proposed tokens the main model accepts
+        self.drafter = drafter
+        self.lock = threading.Lock()
+        self.proposed = 0
+        self.accepted = 0
+        self.calls = 0
+        self.last_context = None
+        self.last_draft = None
+
+    @classmethod
+    def from_setting(cls, setting, n_ctx=512, num_pred_tokens=None):
+        # "lookup" drafts from n-grams already in the prompt, anything else is a draft GGUF path
+        if setting == "lookup":
+            from llama_cpp.llama_speculative import LlamaPromptLookupDecoding
+            return cls(LlamaPromptLookupDecoding(num_pred_tokens=num_pred_tokens or 10))
+        return cls(DraftModelDecoding(setting, num_pred_tokens=num_pred_tokens or 8, n_ctx=n_ctx))
+
+    def __call__(self, input_ids, **kwargs):
+        with self.lock:
+            self.score(input_ids)
+            draft = self.drafter(input_ids, **kwargs)
+            self.calls += 1
+            self.last_context = len(input_ids)
+            self.last_draft = draft
+            return draft
+
+    def score(self, input_ids):
+        # The next call sees the tokens the main model kept, so the previous draft can be checked against them
+        if self.last_draft is None or not len(self.last_draft) or len(input_ids) <= self.last_context:
+            return
+        kept = input_ids[self.last_context:self.last_context + len(self.last_draft)]
+        matches = kept == self.last_draft[:len(kept)]
+        accepted = len(kept) if matches.all() else int(np.argmin(matches))
+        self.proposed += len(self.last_draft)
+        self.accepted += accepted
+        self.last_draft = None
+
+    def reset(self):
+        # A new completion starts from a different context, the pending draft can no longer be scored
+        with self.lock:
+            self.last_context = None
+            self.last_draft = None
+
+    def stats(self):
+        with self.lock:
+            return {
+                "drafts": self.calls,
+                "proposed_tokens": self.proposed,
+                "accepted_tokens": self.accepted,
+                "acceptance_rate": self.accepted / self.proposed if self.proposed else None,
+            }
@@ -0,0 +1,80 @@
+import os
+import threading
+
+from processWorker import ProcessChatModel
+
+def split_cpus(n_workers, cpus=None):
+    # Give each worker a contiguous block of CPUs, neighbouring ids usually share a socket
+    if cpus is None:
+        cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else list(range(os.cpu_count() or 1))
+    size = max(len(cpus) // n_workers, 1)
+    return [cpus[i * size:(i + 1) * size] or cpus for i in range(n_workers)]
+
+class WorkerPool:
+    def __init__(self, model_path, chat_format, n_workers=2, n_threads=None, pin_cpus=True, options=None):
+        # Each worker is a separate process with its own llama context. The weights are
+        # memory-mapped, so the processes share one copy of the model in the page cache
+        self.model_path = model_path
+        self.chat_format = chat_format
+        self.n_workers = n_workers
+        cpu_sets = split_cpus(n_workers)
+        self.workers = []
+        for cpus in cpu_sets:
+            worker_options = dict(options or {})
+            llama_options = dict(worker_options.get("llama_options") or {})
+            llama_options.setdefault("n_threads", n_threads or len(cpus))
+            llama_options.setdefault("n_threads_batch", n_threads or len(cpus))
+            worker_options["llama_options"] = llama_options
+            if pin_cpus:
+                worker_options["cpu_affinity"] = cpus
+            self.workers.append(ProcessChatModel(model_path, chat_format, worker_options))
+        # Requests queued or running on each worker
+        self.loads = [0] * n_workers
+        # Worker that last answered each session, its KV cache already holds that conversation
+        self.session_workers = {}
+        self.lock = threading.Lock()
+
+    def acquire_worker(self, session_id=None):
+        with self.lock:
+            least = min(self.loads)
+            index = self.session_workers.get(session_id)
+            if index is None or self.loads[index] > least:
+                index = self.loads.index(least)
+            self.loads[index] += 1
+            if session_id is not None:
+                self.session_workers[session_id] = index
+            return index
+
+    def release_worker(self, index):
+        with self.lock:
+            self.loads[index] -= 1
+
+    def generate(self, question, messages=None, session_id=None, stream=False, sampling_params=None):
+        # Run one request on the least-loaded worker, returning the reply and the updated conversation
+        tokens = self.stream(question, messages, session_id, sampling_params)
+        if stream:
+            return tokens
+        return "".join(tokens)
+
+    def stream(self, question, messages=None, session_id=None, sampling_params=None):
+        index = self.acquire_worker(session_id)
+        worker = self.workers[index]
+        try:
+            # The worker's lock serialises requests that land on the same process
+            for token in worker.stream_response(question, messages or [], session_id, sampling_params):
+                yield token
+        finally:
+            self.release_worker(index)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "workers": self.n_workers,
+                "loads": list(self.loads),
+                "restarts": [worker.restarts for worker in self.workers],
+                "caches": [worker.cache_stats() for worker in self.workers],
+            }
+
+    def close(self):
+        for worker in self.workers:
+            worker.close()